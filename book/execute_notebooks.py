@@ -0,0 +1,174 @@
+'''
+Pre-execute the book notebooks into the jupyter-cache used by `jupyter-book build` (execute_notebooks: cache)
+
+jupyter-cache keys every notebook by a hash of its code cells and kernelspec, so only notebooks whose code
+changed since the last build are executed; they are run in parallel, the book build then only renders.
+The cache is cleared whenever the environment (lock files and python version) changes, so cached outputs
+never come from a different set of packages.
+
+Usage (from the repository root, after the book/tutorials and book/projects symlinks are created):
+    python book/execute_notebooks.py --jobs 4
+    python book/execute_notebooks.py --dry-run           # list the notebooks that would be executed
+'''
+import os
+import sys
+import time
+import hashlib
+import argparse
+import platform
+import traceback
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+import nbformat as nbf
+
+book_dir = os.path.dirname(os.path.abspath(__file__))
+lock_files = ['requirements.txt', 'environment.yml']
+env_hash_file = 'environment.hash'
+
+
+def get_config():
+    with open(os.path.join(book_dir, '_config.yml'), 'r') as f:
+        return yaml.load(f, Loader=yaml.SafeLoader)
+
+
+def get_cache_path(config):
+    # same default as jupyter-book: _build/.jupyter_cache in the book directory
+    path = config['execute'].get('cache') or os.path.join('_build', '.jupyter_cache')
+    return os.path.join(book_dir, path)
+
+
+def get_toc_notebooks():
+    # notebooks listed in _toc.yml, relative to the book directory
+    def walk(entries):
+        for entry in entries:
+            if 'file' in entry:
+                yield entry['file']
+            for key in ('chapters', 'sections', 'parts'):
+                if key in entry:
+                    yield from walk(entry[key])
+
+    with open(os.path.join(book_dir, '_toc.yml'), 'r') as f:
+        toc = yaml.load(f, Loader=yaml.SafeLoader)
+    if isinstance(toc, dict):
+        toc = [toc]
+    fnames = [os.path.join(book_dir, fname) for fname in walk(toc) if fname.endswith('.ipynb')]
+    return list(dict.fromkeys(fnames))
+
+
+def excluded(fname, patterns):
+    relpath = os.path.relpath(fname, book_dir)
+    return any(fnmatch(relpath, pattern) for pattern in patterns)
+
+
+def environment_hash(root, pip_freeze=False):
+    # hash of the lock files, the python version and optionally every installed distribution
+    digest = hashlib.sha256(platform.python_version().encode('utf-8'))
+    for fname in lock_files:
+        path = os.path.join(root, fname)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    if pip_freeze:
+        from importlib import metadata
+        dists = sorted('%s==%s' % (d.metadata['Name'], d.version) for d in metadata.distributions())
+        digest.update('\n'.join(dists).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def check_environment(cache, cache_path, env_hash):
+    # clear the cache when it was filled in a different environment
+    fname = os.path.join(cache_path, env_hash_file)
+    previous = None
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            previous = f.read().strip()
+    if previous != env_hash:
+        if previous is not None:
+            print('Environment changed, clearing the execution cache')
+        cache.clear_cache()
+        os.makedirs(cache_path, exist_ok=True)
+        with open(fname, 'w') as f:
+            f.write(env_hash + '\n')
+
+
+def stale_notebooks(cache, fnames):
+    # notebooks without a cached execution of their current code
+    stale = []
+    for fname in fnames:
+        try:
+            cache.match_cache_file(fname)
+        except KeyError:
+            stale.append(fname)
+    return stale
+
+
+def execute_notebook(fname, timeout, allow_errors):
+    # runs in a worker process; returns (executed notebook, run time, traceback or None)
+    from nbclient import NotebookClient
+
+    t0 = time.perf_counter()
+    notebook = nbf.read(fname, nbf.NO_CONVERT)
+    kernel_name = notebook.metadata.get('kernelspec', {}).get('name', 'python3')
+    # cell metadata is part of the cache key, so execution timings must not be recorded
+    client = NotebookClient(notebook, timeout=timeout, kernel_name=kernel_name, allow_errors=allow_errors,
+                            record_timing=False, resources={'metadata': {'path': os.path.dirname(fname)}})
+    try:
+        client.execute()
+    except Exception:
+        return notebook, time.perf_counter() - t0, traceback.format_exc()
+    return notebook, time.perf_counter() - t0, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Execute changed book notebooks in parallel into the jupyter-cache')
+    parser.add_argument('notebooks', nargs='*', help='notebooks to consider (default: every notebook in _toc.yml)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of notebooks executed in parallel')
+    parser.add_argument('--pip-freeze', action='store_true', help='also invalidate the cache when any installed package changes')
+    parser.add_argument('--dry-run', action='store_true', help='only list the notebooks that would be executed')
+    parser.add_argument('--strict', action='store_true', help='exit with 1 if any notebook fails to execute')
+    args = parser.parse_args(argv)
+
+    from jupyter_cache import get_cache
+    from jupyter_cache.base import NbBundleIn
+
+    config = get_config()
+    execute = config['execute']
+    cache_path = get_cache_path(config)
+    cache = get_cache(cache_path)
+    check_environment(cache, cache_path, environment_hash(os.path.dirname(book_dir), args.pip_freeze))
+
+    fnames = [os.path.abspath(fname) for fname in args.notebooks] or get_toc_notebooks()
+    fnames = [fname for fname in fnames if not excluded(fname, execute.get('exclude_patterns') or [])]
+    stale = stale_notebooks(cache, fnames)
+    print('%i of %i notebooks need to be executed' % (len(stale), len(fnames)))
+    if args.dry_run:
+        for fname in stale:
+            print(os.path.relpath(fname, book_dir))
+        return 0
+
+    # the cache is an SQLite database: execute in the workers, store from this process only
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(execute_notebook, fname, execute['timeout'], execute['allow_errors']): fname
+                   for fname in stale}
+        for future in as_completed(futures):
+            fname = futures[future]
+            notebook, elapsed, error = future.result()
+            if error is not None:
+                failed.append(fname)
+                print('Execution failed for notebook:', fname, '\n', error)
+                continue
+            cache.cache_notebook_bundle(NbBundleIn(notebook, uri=fname), check_validity=False, overwrite=True)
+            print('%8.1f s  %s' % (elapsed, os.path.relpath(fname, book_dir)))
+    # as jupyter-book itself, failures are only reported by default, the book is still built
+    if failed:
+        print('%i notebooks failed to execute:' % len(failed))
+        for fname in failed:
+            print('   ', os.path.relpath(fname, book_dir))
+    return 1 if failed and args.strict else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+
+
+def cell_hash(cell):
+    return hashlib.sha256(cell.encode('utf-8')).hexdigest()
+
+
+class CacheStore:
+    # SQLite store for the chatify responses, keyed by (cell hash, prompt name).  Every response
+    # is committed as soon as it is written, so an interrupted run can be resumed; failed queries
+    # are kept in their own table.  Implements the same load/append/missing interface as
+    # populate_cache.JSONLCheckpoint.
+    # key_func maps a cell to its hash, e.g. dedup.DedupIndex.key so that cells that only differ
+    # in comments or whitespace share their responses; the variants table records which source
+    # cells map to which key
+    def __init__(self, fname, key_func=cell_hash):
+        self.fname = fname
+        self.key_func = key_func
+        self.db = sqlite3.connect(fname)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                   cell_hash TEXT NOT NULL,
+                                   prompt TEXT NOT NULL,
+                                   cell TEXT NOT NULL,
+                                   response TEXT NOT NULL,
+                                   updated REAL NOT NULL,
+                                   PRIMARY KEY (cell_hash, prompt))''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS failed_queries (
+                                   cell_hash TEXT NOT NULL,
+                                   prompt TEXT NOT NULL,
+                                   cell TEXT NOT NULL,
+                                   reason TEXT NOT NULL,
+                                   updated REAL NOT NULL,
+                                   PRIMARY KEY (cell_hash, prompt))''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS variants (
+                                   cell TEXT PRIMARY KEY,
+                                   cell_hash TEXT NOT NULL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS variants_hash ON variants (cell_hash)')
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def get(self, cell, prompt):
+        row = self.db.execute('SELECT response FROM responses WHERE cell_hash = ? AND prompt = ?',
+                              (self.key_func(cell), prompt)).fetchone()
+        return None if row is None else row[0]
+
+    def upsert(self, cell, prompt, response):
+        with self.db:
+            self._upsert(cell, prompt, response)
+
+    def _upsert(self, cell, prompt, response):
+        key = self.key_func(cell)
+        self.db.execute('''INSERT INTO responses (cell_hash, prompt, cell, response, updated) VALUES (?, ?, ?, ?, ?)
+                           ON CONFLICT (cell_hash, prompt) DO UPDATE SET response = excluded.response, updated = excluded.updated''',
+                        (key, prompt, cell, response, time.time()))
+        self.db.execute('DELETE FROM failed_queries WHERE cell_hash = ? AND prompt = ?', (key, prompt))
+
+    def add_failed(self, cell, prompt, reason):
+        with self.db:
+            self.db.execute('''INSERT INTO failed_queries (cell_hash, prompt, cell, reason, updated) VALUES (?, ?, ?, ?, ?)
+                               ON CONFLICT (cell_hash, prompt) DO UPDATE SET reason = excluded.reason, updated = excluded.updated''',
+                            (self.key_func(cell), prompt, cell, reason, time.time()))
+
+    def append(self, cell, prompt, response=None, failed=None):
+        if failed is None:
+            self.upsert(cell, prompt, response)
+        else:
+            self.add_failed(cell, prompt, failed)
+
+    def load(self):
+        responses = {(cell, prompt): response for cell, prompt, response in self.entries()}
+        failed = {(cell, prompt): reason for cell, prompt, reason in self.failed_queries()}
+        return responses, failed
+
+    def missing(self, cells, prompts):
+        # (cell, prompt) pairs without a response
+        done = set(self.db.execute('SELECT cell_hash, prompt FROM responses'))
+        return [(cell, prompt) for cell in cells for prompt in prompts
+                if (self.key_func(cell), prompt) not in done]
+
+    def add_variants(self, variants):
+        # record (source cell, key) pairs, see dedup.DedupIndex.variants
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO variants (cell, cell_hash) VALUES (?, ?)', variants)
+
+    def entries(self):
+        # (cell, prompt, response) for the stored cells and every recorded variant of them
+        return self.db.execute('''SELECT cell, prompt, response FROM responses
+                                  UNION
+                                  SELECT variants.cell, prompt, response FROM variants
+                                  JOIN responses ON variants.cell_hash = responses.cell_hash
+                                  ORDER BY cell, prompt''')
+
+    def failed_queries(self):
+        return self.db.execute('SELECT cell, prompt, reason FROM failed_queries ORDER BY cell_hash, prompt').fetchall()
+
+    def import_pickle(self, pickle_file, failed_queries_file=None):
+        # one-off migration of the old nested-dict cache.pkl (and failed_queries.pkl)
+        with open(pickle_file, 'rb') as f:
+            cache = pickle.load(f)
+        with self.db:
+            for cell, responses in cache.items():
+                for prompt, response in responses.items():
+                    if response is not None and len(response) > 0:
+                        self._upsert(cell, prompt, response)
+        if failed_queries_file is not None and os.path.exists(failed_queries_file):
+            with open(failed_queries_file, 'rb') as f:
+                for cell, prompt, reason in pickle.load(f):
+                    if self.get(cell, prompt) is None:
+                        self.add_failed(cell, prompt, reason)
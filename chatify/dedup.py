@@ -0,0 +1,150 @@
+import io
+import keyword
+import builtins
+import hashlib
+import tokenize
+
+_skip_tokens = {tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER}
+_builtin_names = set(dir(builtins))
+# conventional module aliases of the notebooks, kept even when the import is in another cell, so that e.g.
+# plt.plot(x) and ax.plot(x) do not get the same key
+_module_aliases = {'np', 'plt', 'pd', 'xr', 'mpl', 'sns', 'ccrs', 'cfeature', 'cm', 'gpd', 'os', 'dt', 'sm',
+                   'stats', 'cmocean', 'pooch', 'tempfile', 'random', 'numpy', 'matplotlib', 'xarray', 'pandas'}
+
+
+def _imported_names(tokens):
+    # names of modules and aliases bound by the import statements of the cell
+    names = set()
+    in_import = False
+    for tok in tokens:
+        if tok.type == tokenize.NEWLINE:
+            in_import = False
+        elif tok.type == tokenize.NAME and tok.string in ('import', 'from') and not tok.line[:tok.start[1]].strip():
+            # statement start only, not `yield from` / `raise ... from`
+            in_import = True
+        elif in_import and tok.type == tokenize.NAME and not keyword.iskeyword(tok.string):
+            names.add(tok.string)
+    return names
+
+
+def _normalize_lines(source):
+    # fallback for cells the python tokenizer rejects (IPython magics, shell escapes, ...):
+    # drop comment lines and collapse whitespace
+    lines = [' '.join(line.split()) for line in source.split('\n')]
+    return '\n'.join(line for line in lines if line and not line.startswith('#'))
+
+
+def normalize_cell(source, rename_variables=False):
+    '''
+    Canonical form of a code cell: comments (including `# @title` headers), blank lines and
+    whitespace are removed. With rename_variables, names that are not keywords, builtins,
+    imported modules, attributes or keyword arguments of calls are replaced by v0, v1, ... in order of
+    appearance (function parameters, with or without default, are renamed).
+    '''
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return _normalize_lines(source)
+
+    names = {}
+    lines = []
+    line = []
+    # kind of every open bracket: 'params' for the parameter list of a def, else the bracket itself;
+    # lambda parameters are open until their ':'
+    brackets = []
+    lambdas = []
+    keep = _module_aliases | _imported_names(tokens) if rename_variables else set()
+    prev = prev2 = None
+    for i, tok in enumerate(tokens):
+        if tok.type in _skip_tokens:
+            continue
+        if tok.type == tokenize.NEWLINE:
+            if line:
+                lines.append(' '.join(line))
+            line = []
+            continue
+        if tok.type == tokenize.INDENT:
+            line.append('<indent>')
+            continue
+        if tok.type == tokenize.DEDENT:
+            line.append('<dedent>')
+            continue
+        if tok.type == tokenize.ERRORTOKEN and tok.string.isspace():
+            continue
+
+        string = tok.string
+        if tok.type == tokenize.OP:
+            if string in '([{':
+                is_def = string == '(' and prev2 is not None and prev2.string == 'def'
+                brackets.append('params' if is_def else string)
+            elif string in ')]}' and brackets:
+                brackets.pop()
+            elif string == ':' and lambdas and lambdas[-1] == len(brackets):
+                lambdas.pop()
+        elif rename_variables and tok.type == tokenize.NAME:
+            if string == 'lambda':
+                lambdas.append(len(brackets))
+            nxt = tokens[i + 1].string if i + 1 < len(tokens) else ''
+            is_attribute = prev is not None and prev.string == '.'
+            in_params = (brackets and brackets[-1] == 'params') or (lambdas and lambdas[-1] == len(brackets))
+            is_kwarg = bool(brackets) and brackets[-1] == '(' and nxt == '=' and not in_params
+            if not (keyword.iskeyword(string) or string in _builtin_names or string in keep or is_attribute
+                    or is_kwarg):
+                string = names.setdefault(string, 'v%i' % len(names))
+        line.append(string)
+        prev2, prev = prev, tok
+    if line:
+        lines.append(' '.join(line))
+    return '\n'.join(lines)
+
+
+def cell_key(source, rename_variables=False):
+    return hashlib.sha256(normalize_cell(source, rename_variables).encode('utf-8')).hexdigest()
+
+
+class DedupIndex:
+    # maps every source cell to the key of its normalized form; the first cell seen for a key is
+    # its canonical cell, the one that is sent to the LLM
+    def __init__(self, rename_variables=False):
+        self.rename_variables = rename_variables
+        self.keys = {}  # source cell -> key
+        self.canonical = {}  # key -> canonical source cell
+        self.n_cells = 0
+
+    def key(self, source):
+        if source in self.keys:
+            return self.keys[source]
+        return cell_key(source, self.rename_variables)
+
+    def add(self, source):
+        self.n_cells += 1
+        key = self.keys.get(source)
+        if key is None:
+            key = cell_key(source, self.rename_variables)
+            self.keys[source] = key
+            self.canonical.setdefault(key, source)
+        return key
+
+    def update(self, sources):
+        for source in sources:
+            self.add(source)
+        return self
+
+    def canonical_cells(self):
+        return list(self.canonical.values())
+
+    def variants(self):
+        # (source cell, key) for every distinct source cell
+        return list(self.keys.items())
+
+    def stats(self):
+        n_unique = len(self.canonical)
+        return {
+            'cells': self.n_cells,
+            'distinct_sources': len(self.keys),
+            'unique': n_unique,
+            'duplicates': self.n_cells - n_unique,
+            'hit_rate': (self.n_cells - n_unique) / self.n_cells if self.n_cells else 0.,
+            'exact_duplicates': self.n_cells - len(self.keys),
+            'normalized_duplicates': len(self.keys) - n_unique,
+        }
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import random
+import asyncio
+
+from tqdm import tqdm
+
+
+class TokenBucket:
+    # allows `rate` requests per second on average, with bursts of up to `capacity` requests
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class JSONLCheckpoint:
+    # append-only log of responses and failures, one JSON record per line; a run that is
+    # interrupted can be resumed by loading the log
+    def __init__(self, fname):
+        self.fname = fname
+
+    def load(self):
+        responses = {}
+        failed = {}
+        if not os.path.exists(self.fname):
+            return responses, failed
+        with open(self.fname, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # partially written last line
+                    continue
+                key = (record['cell'], record['prompt'])
+                if 'response' in record:
+                    responses[key] = record['response']
+                    failed.pop(key, None)
+                else:
+                    failed[key] = record['failed']
+        return responses, failed
+
+    def append(self, cell, prompt, response=None, failed=None):
+        record = {'cell': cell, 'prompt': prompt}
+        if failed is None:
+            record['response'] = response
+        else:
+            record['failed'] = failed
+        with open(self.fname, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def missing(self, cells, prompts):
+        # (cell, prompt) pairs without a response
+        done, _ = self.load()
+        return [(cell, prompt) for cell in cells for prompt in prompts
+                if len(done.get((cell, prompt)) or '') == 0]
+
+    def remove(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+async def _query_with_retry(query, cell, content, bucket, max_retries, backoff):
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            await bucket.acquire()
+        try:
+            return await asyncio.to_thread(query, cell, content)
+        except Exception:
+            if attempt == max_retries:
+                raise
+            # exponential backoff with jitter
+            await asyncio.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+async def populate(tasks, query, checkpoint, concurrency=8, rate=None, max_retries=5, backoff=1.):
+    '''
+    Query the LLM for every (cell, prompt name, prompt content) in tasks
+    - query: blocking function query(cell, content) -> response, e.g. Chatify()._cache, or a
+      local stub for testing offline
+    - checkpoint: every response/failure is appended to it as soon as it arrives
+    - concurrency: maximum number of requests in flight
+    - rate: maximum number of requests per second (None: unlimited)
+    - max_retries, backoff: retries after an exception, waiting backoff * 2**attempt seconds
+    Returns {(cell, prompt name): response} and {(cell, prompt name): failure reason}
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(rate) if rate else None
+    responses = {}
+    failed = {}
+    progress = tqdm(total=len(tasks))
+
+    async def run(cell, name, content):
+        async with semaphore:
+            try:
+                response = await _query_with_retry(query, cell, content, bucket, max_retries, backoff)
+            except Exception:
+                response, reason = None, 'exception raised'
+            else:
+                reason = 'null response' if response is None or len(response) == 0 else None
+
+        if reason is None:
+            responses[(cell, name)] = response
+            checkpoint.append(cell, name, response=response)
+        else:
+            failed[(cell, name)] = reason
+            checkpoint.append(cell, name, failed=reason)
+            print('Response failed for cell (%s):\n' % reason, cell)
+        progress.update()
+
+    await asyncio.gather(*[run(cell, name, content) for cell, name, content in tasks])
+    progress.close()
+    return responses, failed
+
+
+def populate_cache(cells, prompts, query, checkpoint, **kwargs):
+    '''
+    Query all prompts for all cells, storing the responses in checkpoint (a JSONLCheckpoint or
+    cache_store.CacheStore). Entries already in the checkpoint are not queried again.
+    kwargs are passed on to populate. Returns the list of failed (cell, prompt name, reason).
+    '''
+    tasks = [(cell, name, prompts[name]) for cell, name in checkpoint.missing(cells, list(prompts))]
+
+    _, failed = asyncio.run(populate(tasks, query, checkpoint, **kwargs))
+    return [(cell, name, failed[(cell, name)]) for cell, name, _ in tasks if (cell, name) in failed]
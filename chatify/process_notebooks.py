@@ -1,186 +1,373 @@
 import os
+import json
 import yaml
+import shutil
+import hashlib
+import tempfile
+import traceback
+import time
 from glob import glob as lsdir
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import nbformat as nbf
 from chatify import Chatify
 from tqdm import tqdm
+from populate_cache import populate_cache
+from cache_store import CacheStore
+from dedup import DedupIndex
+from timing_report import TimingReport, profiled
 
-import numpy as np
 import pickle
 
+import cachetools
 from langchain.prompts import PromptTemplate
-from gptcache import Cache
-from gptcache.processor.pre import get_prompt
 from gptcache.manager import get_data_manager
-from gptcache.similarity_evaluation.exact_match import ExactMatchEvaluation
 
 source_repo = 'ClimatematchAcademy'
 mod_repo = 'ContextLab'
 CACHE = False
+N_JOBS = os.cpu_count()  # number of processes for notebook processing, 1 runs serially
+CONCURRENCY = 8  # maximum number of LLM requests in flight when building the cache
+RATE_LIMIT = None  # maximum number of LLM requests per second, None for no limit
+RENAME_VARIABLES = False  # also treat cells that only differ in variable names as duplicates
+REPORT_FILE = os.path.join(os.getcwd(), 'chatify', 'timing_report.json')  # None to skip the timing report
+PROFILE_FILE = None  # e.g. 'chatify/process_notebooks.prof' to dump cProfile stats, runs the notebooks serially
+
+template_files = ['background.md', 'install_davos.py', 'install_and_load_chatify.py']
+hash_file = os.path.join(os.getcwd(), 'chatify', 'notebook_hashes.json')
 
 
 def get_tutorial_notebooks(basedir):
-    return lsdir(os.path.join(basedir, 'tutorials', '*', 'student', '*Tutorial*.ipynb')) + \
-           lsdir(os.path.join(basedir, 'tutorials', '*', 'instructor', '*Tutorial*.ipynb')) + \
-           lsdir(os.path.join(basedir, 'tutorials', '*', '*Tutorial*.ipynb'))
+    patterns = [os.path.join(basedir, 'tutorials', '*', 'student', '*Tutorial*.ipynb'),
+                os.path.join(basedir, 'tutorials', '*', 'instructor', '*Tutorial*.ipynb'),
+                os.path.join(basedir, 'tutorials', '*', '*Tutorial*.ipynb')]
+    # sorted within each pattern so the order does not depend on the file system, duplicates removed
+    fnames = [os.path.normpath(fname) for pattern in patterns for fname in sorted(lsdir(pattern))]
+    return list(dict.fromkeys(fnames))
 
 
-def chatified(fname):
-    notebook = nbf.read(fname, nbf.NO_CONVERT)
+def chatified(notebook):
     header_cell = notebook['cells'][0]
     return mod_repo in header_cell['source']
 
 
+def find_chatify_cells(notebook):
+    # index of the background cell of an existing background/davos/chatify block, or None
+    cells = notebook['cells']
+    for idx in range(len(cells) - 2):
+        if cells[idx]['cell_type'] == 'markdown' and 'Chatify' in cells[idx]['source'] and \
+                cells[idx + 1]['cell_type'] == 'code' and 'davos' in cells[idx + 1]['source'] and \
+                cells[idx + 2]['cell_type'] == 'code' and 'chatify' in cells[idx + 2]['source']:
+            return idx
+    return None
+
+
 def get_text(fname):
     with open(os.path.join(os.getcwd(), 'chatify', fname), 'r') as f:
         return ''.join(f.readlines())
 
 
-def inject_chatify(fname):
-    notebook = nbf.read(fname, nbf.NO_CONVERT)
-    new_notebook = notebook.copy()
+def load_templates():
+    return {fname: get_text(fname) for fname in template_files}
+
+
+def replace_cell(notebook, idx, new_cell):
+    # keep the existing cell (and its id) if it is already up to date
+    cell = notebook.cells[idx]
+    if cell['cell_type'] == new_cell['cell_type'] and cell['source'] == new_cell['source'] and \
+            cell['metadata'] == new_cell['metadata']:
+        return False
+    if 'id' in cell:
+        new_cell['id'] = cell['id']
+    notebook.cells[idx] = new_cell
+    return True
+
+
+def inject_chatify(notebook, templates):
+    # updates the notebook in place, returns whether anything changed
 
     # update header cell
-    header_cell = new_notebook['cells'][0]
-    header_cell['source'] = header_cell['source'].replace(source_repo, mod_repo)
+    header_cell = notebook['cells'][0]
+    header_source = header_cell['source'].replace(source_repo, mod_repo)
+    changed = header_source != header_cell['source']
+    header_cell['source'] = header_source
 
     # insert background cell
-    background_cell = nbf.v4.new_markdown_cell(source=get_text('background.md'), metadata={'execution': {}})
+    background_cell = nbf.v4.new_markdown_cell(source=templates['background.md'], metadata={'execution': {}})
     del background_cell['id']
 
     # create davos cell
-    davos_cell = nbf.v4.new_code_cell(source=get_text('install_davos.py'), metadata={'cellView': 'form', 'execution': {}})
+    davos_cell = nbf.v4.new_code_cell(source=templates['install_davos.py'], metadata={'cellView': 'form', 'execution': {}})
     del davos_cell['id']
 
     # create chatify cell
-    chatify_cell = nbf.v4.new_code_cell(source=get_text('install_and_load_chatify.py'), metadata={'cellView': 'form', 'execution': {}})
+    chatify_cell = nbf.v4.new_code_cell(source=templates['install_and_load_chatify.py'], metadata={'cellView': 'form', 'execution': {}})
     del chatify_cell['id']
 
-    idx = 0
-    for cell in new_notebook['cells']:
-        idx += 1
-        if cell['cell_type'] == 'markdown':
-            if '# Setup' in cell['source']:
-                break
-
-    if chatified(fname):
-        new_notebook.cells[0] = header_cell
-        new_notebook.cells[idx] = background_cell
-        new_notebook.cells[idx + 1] = davos_cell
-        new_notebook.cells[idx + 2] = chatify_cell
+    # an existing block is updated where it is, so rerunning does not insert it again
+    idx = find_chatify_cells(notebook)
+    if idx is not None:
+        changed |= replace_cell(notebook, idx, background_cell)
+        changed |= replace_cell(notebook, idx + 1, davos_cell)
+        changed |= replace_cell(notebook, idx + 2, chatify_cell)
     else:
-        new_notebook.cells.insert(idx, background_cell)
-        new_notebook.cells.insert(idx + 1, davos_cell)
-        new_notebook.cells.insert(idx + 2, chatify_cell)
-
-    # Write the file
-    nbf.write(
-        new_notebook,
-        fname,
-        version=nbf.NO_CONVERT,
-    )
+        idx = 0
+        for cell in notebook['cells']:
+            idx += 1
+            if cell['cell_type'] == 'markdown':
+                if '# Setup' in cell['source']:
+                    break
+        notebook.cells.insert(idx, background_cell)
+        notebook.cells.insert(idx + 1, davos_cell)
+        notebook.cells.insert(idx + 2, chatify_cell)
+        changed = True
+    return changed
 
 
 def compress_code(text):
     return '\n'.join([line.strip() for line in text.split('\n') if len(line.strip()) > 0])
 
 
-def get_code_cells(fname):
-    notebook = nbf.read(fname, nbf.NO_CONVERT)
+def get_code_cells(notebook):
     return [compress_code(cell['source']) for cell in notebook['cells'] if cell['cell_type'] == 'code']
 
 
+def content_hash(text, templates):
+    digest = hashlib.sha256()
+    for fname in template_files:
+        digest.update(templates[fname].encode('utf-8'))
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_hashes():
+    if os.path.exists(hash_file):
+        with open(hash_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_hashes(hashes):
+    with open(hash_file, 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+
+
+def process_notebook(fname, templates, record=None):
+    # one read and at most one write per notebook; notebooks that are unchanged since their
+    # last processing (same content and templates) are skipped and reuse the stored code cells.
+    # Returns the updated hash record {'hash': ..., 'code_cells': [...]} and timing stats
+    t0 = time.perf_counter()
+    with open(fname, 'r', encoding='utf-8') as f:
+        text = f.read()
+    stats = {'read': time.perf_counter() - t0, 'bytes_read': len(text.encode('utf-8')),
+             'bytes_written': 0, 'skipped': False, 'written': False}
+
+    if record is not None and record['hash'] == content_hash(text, templates):
+        stats['skipped'] = True
+        stats['total'] = time.perf_counter() - t0
+        return record, stats
+
+    t = time.perf_counter()
+    notebook = nbf.reads(text, nbf.NO_CONVERT)
+    stats['parse'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    changed = inject_chatify(notebook, templates)
+    stats['inject'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    code_cells = get_code_cells(notebook)
+    stats['extract'] = time.perf_counter() - t
+
+    # notebooks that are already up to date are not written at all
+    t = time.perf_counter()
+    if changed:
+        new_text = nbf.writes(notebook, version=nbf.NO_CONVERT)
+        if not new_text.endswith('\n'):
+            new_text += '\n'
+        if new_text != text:
+            write_atomic(fname, new_text)
+            text = new_text
+            stats['written'] = True
+            stats['bytes_written'] = len(text.encode('utf-8'))
+    stats['write'] = time.perf_counter() - t
+    stats['total'] = time.perf_counter() - t0
+
+    return {'hash': content_hash(text, templates), 'code_cells': code_cells}, stats
+
+
+def write_atomic(fname, text):
+    # write to a temporary file next to fname and rename it, so fname is never left half-written
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.' + os.path.basename(fname), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        shutil.copymode(fname, tmp)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _process_notebook_safe(templates, args):
+    fname, record = args
+    try:
+        return process_notebook(fname, templates, record) + (None,)
+    except Exception:
+        return None, None, traceback.format_exc()
+
+
+def process_notebooks(fnames, templates, hashes, n_jobs=1, report=None):
+    # process notebooks (in parallel for n_jobs > 1), results are in the order of fnames.
+    # Returns the code cells of all notebooks and a list of (fname, traceback) for failed files;
+    # hashes is updated in place, per-notebook timings are added to report (a TimingReport)
+    keys = [os.path.relpath(fname, os.getcwd()) for fname in fnames]
+    tasks = [(fname, hashes.get(key)) for fname, key in zip(fnames, keys)]
+    func = partial(_process_notebook_safe, templates)
+
+    if n_jobs == 1:
+        results = [func(task) for task in tqdm(tasks)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(tqdm(executor.map(func, tasks, chunksize=4), total=len(tasks)))
+
+    code_cells = []
+    errors = []
+    for fname, key, (record, stats, error) in zip(fnames, keys, results):
+        if error is not None:
+            errors.append((fname, error))
+            continue
+        hashes[key] = record
+        if report is not None:
+            report.add_notebook(key, stats)
+        code_cells.extend(record['code_cells'])
+    return code_cells, errors
+
+
+def compile_prompts(prompts):
+    return {
+        prompt_name: PromptTemplate(template=prompt['content'], input_variables=prompt['input_variables'])
+        for prompt_name, prompt in prompts.items()
+    }
+
+
+def write_gptcache(file_name, entries, prompts):
+    # entries: (cell, prompt name, answer).  The questions are built with one compiled template per
+    # prompt, and only new or changed entries are written into the existing cache file, in one batch
+    # and one flush.  Entries that are no longer present are dropped, so the result is the same as
+    # rebuilding the file from scratch.  Returns the number of inserted and removed entries
+    templates = compile_prompts(prompts)
+    cache = {}
+    for cell, prompt_name, answer in entries:
+        if prompt_name in templates and answer is not None:
+            cache[templates[prompt_name].format(text=compress_code(cell))] = answer
+
+    # the map data manager is an LRU cache, make sure it can hold every entry
+    data_manager = get_data_manager(data_path=file_name, max_size=max(1000, len(cache)))
+    data = data_manager.data
+    if data.maxsize < len(cache):
+        data_manager.data = cachetools.LRUCache(len(cache))
+        data_manager.data.update(data)
+        data = data_manager.data
+
+    removed = [question for question in data if question not in cache]
+    for question in removed:
+        del data[question]
+    questions = [question for question, answer in cache.items()
+                 if question not in data or data[question][1] != answer]
+
+    if questions or removed:
+        answers = [cache[question] for question in questions]
+        data_manager.import_data(questions, answers, questions, [None] * len(questions))
+        data_manager.flush()
+    return len(questions), len(removed)
+
+
 def convert_pickle_file_to_cache(pickle_file, config):
     cache_db_version = config['cache_config']['cache_db_version']
     file_name = f'NMA_2023_v{cache_db_version}.cache'
 
-    # Remove file before creating a new one
-    if os.path.exists(file_name):
-        os.remove(file_name)
-    
-    llm_cache = Cache()
-    llm_cache.set_openai_key()
-    data_manager = get_data_manager(data_path=file_name)
-    
-    llm_cache.init(
-        pre_embedding_func=get_prompt,
-        data_manager=data_manager,
-        similarity_evaluation=ExactMatchEvaluation(),
-    )
-    
     chatify = Chatify()
     prompts = chatify._read_prompt_dir()['tutor']
-    
+
     with open(pickle_file, 'rb') as f:
         cache = pickle.load(f)
-        
-    for key, value in cache.items():
-        for prompt_name, prompt in prompts.items():
-            prompt = PromptTemplate(
-                template=prompt['content'],
-                input_variables=prompt['input_variables'],
-            )
-            question = prompt.format(text=compress_code(key))
-            try:
-                answer = value[prompt_name]
-                data_manager.save(question, answer, embedding_data=question)
-            except KeyError:
-                pass
-
-
-tutorials = get_tutorial_notebooks(os.getcwd())
-tutor = Chatify()
-prompts = tutor._read_prompt_dir()['tutor']
-code_cells = []
-failed_queries = []
-
-for notebook in tqdm(tutorials):
-    inject_chatify(notebook)
-    code_cells.extend(get_code_cells(notebook))
-
-
-if CACHE:
-    savefile = os.path.join(os.getcwd(), 'chatify', 'cache.pkl')
-    failed_queries_file = os.path.join(os.getcwd(), 'chatify', 'failed_queries.pkl')
-
-    if os.path.exists(savefile):
-        with open(savefile, 'rb') as f:
-            cache = pickle.load(f)
-    else:
-        cache = {}
-    
-    failed_queries = []
-
-    tmpfile = os.path.join(os.getcwd(), 'chatify', 'tmp.pkl')
-    for cell in tqdm(np.unique(code_cells)):
-        if cell not in cache:
-            cache[cell] = {}
-        
-        for name, content in prompts.items():
-            if name not in cache[cell] or len(cache[cell][name]) == 0:
-                try:
-                    cache[cell][name] = tutor._cache(cell, content)
-
-                    with open(tmpfile, 'wb') as f:
-                        pickle.dump(cache, f)
-                    
-                    if cache[cell][name] is None or len(cache[cell][name]) == 0:
-                        failed_queries.append((cell, name, 'null response'))
-                        print('Response failed for cell (null response):\n', cell)
-                except:
-                    failed_queries.append((cell, name, 'exception raised'))
-                    print('Response failed for cell (exception raised):\n', cell)
-
-    with open(savefile, 'wb') as f:
-        pickle.dump(cache, f)
-    
-    with open(failed_queries_file, 'wb') as f:
-        pickle.dump(failed_queries, f)
-
-    if os.path.exists(tmpfile):
-        os.remove(tmpfile)
-
-    # build cache
-    config = yaml.load(open('config.yaml', 'r'), Loader=yaml.SafeLoader)
-    convert_pickle_file_to_cache(savefile, config)
+
+    entries = ((key, prompt_name, answer) for key, value in cache.items() for prompt_name, answer in value.items())
+    return write_gptcache(file_name, entries, prompts)
+
+
+def convert_store_to_cache(store, config):
+    cache_db_version = config['cache_config']['cache_db_version']
+    file_name = f'NMA_2023_v{cache_db_version}.cache'
+
+    chatify = Chatify()
+    prompts = chatify._read_prompt_dir()['tutor']
+    return write_gptcache(file_name, store.entries(), prompts)
+
+
+if __name__ == '__main__':
+    report = TimingReport()
+    with profiled(PROFILE_FILE):
+        with report.phase('setup'):
+            tutorials = get_tutorial_notebooks(os.getcwd())
+            tutor = Chatify()
+            prompts = tutor._read_prompt_dir()['tutor']
+            templates = load_templates()
+            hashes = load_hashes()
+            failed_queries = []
+
+        # the profile only covers the main process, so profiled runs process the notebooks serially
+        with report.phase('notebooks'):
+            code_cells, errors = process_notebooks(tutorials, templates, hashes, report=report,
+                                                   n_jobs=1 if PROFILE_FILE else N_JOBS)
+            save_hashes(hashes)
+        report.count('notebook_errors', len(errors))
+        for fname, error in errors:
+            print('Processing failed for notebook:', fname, '\n', error)
+
+        if CACHE:
+            # cells that only differ in comments, `# @title` headers or whitespace share one LLM query
+            with report.phase('dedup'):
+                index = DedupIndex(rename_variables=RENAME_VARIABLES).update(code_cells)
+                stats = index.stats()
+            print('%i code cells, %i unique after normalization (hit rate %.1f%%)' % (stats['cells'], stats['unique'], 100 * stats['hit_rate']))
+            report.count('code_cells', stats['cells'])
+            report.count('unique_cells', stats['unique'])
+
+            with report.phase('cache_store'):
+                store = CacheStore(os.path.join(os.getcwd(), 'chatify', 'cache.db'), key_func=index.key)
+                store.add_variants(index.variants())
+
+                # migrate the responses of the old pickled cache
+                savefile = os.path.join(os.getcwd(), 'chatify', 'cache.pkl')
+                failed_queries_file = os.path.join(os.getcwd(), 'chatify', 'failed_queries.pkl')
+                if len(store) == 0 and os.path.exists(savefile):
+                    store.import_pickle(savefile, failed_queries_file)
+
+            # every response is committed to the store as it arrives, rerunning after an interruption resumes
+            with report.phase('llm_queries'):
+                cells = index.canonical_cells()
+                n_missing = len(store.missing(cells, list(prompts)))
+                report.count('prompt_cache_hits', len(cells) * len(prompts) - n_missing)
+                report.count('prompt_cache_misses', n_missing)
+                failed_queries = populate_cache(cells, prompts, tutor._cache, store,
+                                                concurrency=CONCURRENCY, rate=RATE_LIMIT)
+            report.count('failed_queries', len(failed_queries))
+            if failed_queries:
+                print('%i queries failed, see the failed_queries table in chatify/cache.db' % len(failed_queries))
+
+            # build cache
+            with report.phase('gptcache'):
+                config = yaml.load(open('config.yaml', 'r'), Loader=yaml.SafeLoader)
+                inserted, removed = convert_store_to_cache(store, config)
+            print('gptcache: %i entries written, %i removed' % (inserted, removed))
+            report.count('gptcache_inserted', inserted)
+            report.count('gptcache_removed', removed)
+            store.close()
+
+    print(report.summary())
+    if REPORT_FILE is not None:
+        report.save(REPORT_FILE)
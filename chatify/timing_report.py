@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import platform
+import contextlib
+
+
+class TimingReport:
+    # collects the wall time of each phase of the pipeline, per-notebook timings and byte counts,
+    # and arbitrary counters (e.g. prompt cache hits/misses); written out as one JSON file so runs
+    # can be compared between content releases
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.notebooks = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - t0
+
+    def add_notebook(self, fname, stats):
+        self.notebooks.append(dict(stats, notebook=fname))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def totals(self):
+        totals = {}
+        for stats in self.notebooks:
+            for key, value in stats.items():
+                # booleans (e.g. skipped, written) are counted
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+        totals['notebooks'] = len(self.notebooks)
+        return totals
+
+    def to_dict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'phases': self.phases,
+            'totals': self.totals(),
+            'counters': self.counters,
+            'notebooks': self.notebooks,
+        }
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self):
+        lines = ['%-20s %8.2f s' % (name, seconds) for name, seconds in self.phases.items()]
+        lines += ['%-20s %8i' % (name, n) for name, n in self.counters.items()]
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profiled(fname=None):
+    # run the block under cProfile and dump the stats to fname (readable with pstats or snakeviz);
+    # does nothing for fname=None
+    if fname is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(fname)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
@@ -0,0 +1,163 @@
+'''
+Lazily indexed stacks of the per-date Sentinel-2 .npy scenes of the Wildfires and burnt areas project
+
+The project notebook reads every pre-fire, post-fire and SCL file completely with numpy.load into lists
+(pre_fires_numpy, scl_fires_numpy, ...). A SceneStack opens the files of a folder with mmap_mode='r' instead
+and behaves as a (time, y, x, band) array (SCL stacks: (time, y, x)): indexing reads only the selected
+scenes, window and bands from disk.
+
+    import scene_stack
+    pre = scene_stack.SceneStack.from_folder(os.path.join(rootFolder, continet), 'pre_fire_')
+    scl = scene_stack.SceneStack.from_folder(os.path.join(rootFolder, continet), 'scl_pre_fire_')
+    rgb = pre[2, :, :, [3, 2, 1]]                   # one scene, three bands
+    window = pre.read(window=(slice(0, 256), slice(0, 256)), bands=[3, 7])  # all dates, 256 x 256 pixels
+
+Iterating over a stack yields the scenes one by one, still memory-mapped, so that the functions of
+wildfire_indices (e.g. vci over a multi-year NDVI history, apply_blockwise) never hold the whole stack in
+memory. to_zarr writes the stack once to a chunked zarr store (one chunk per date and 512 x 512 pixels), which
+from_zarr opens with the same interface, e.g. to read small windows of many dates quickly.
+'''
+import os
+import shutil
+
+import numpy as np
+
+
+def find_scenes(folder, prefix):
+    '''
+    Sorted paths of the .npy files of folder whose name starts with prefix (as the file lists of the notebook,
+    but in a reproducible order)
+    '''
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.startswith(prefix) and name.endswith('.npy')]
+
+
+def _oindex(array, key):
+    # orthogonal indexing of a numpy array or memmap, as zarr's oindex: slices and integers first (a view of a
+    # memmap, nothing read), then every list of indices along its own axis
+    basic = tuple(slice(None) if np.ndim(k) else k for k in key)
+    out = array[basic]
+    axis = 0
+    for k in key:
+        if np.ndim(k):
+            out = np.take(out, k, axis=axis)
+        if not isinstance(k, (int, np.integer)):
+            axis += 1
+    return np.asarray(out)
+
+
+class _ZarrScene:
+    # one date of a zarr-backed stack, read only when indexed or converted to an array
+    def __init__(self, array, index):
+        self.array, self.index = array, index
+        self.shape, self.ndim, self.dtype = array.shape[1:], array.ndim - 1, array.dtype
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        return self.array.oindex[(self.index,) + key]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array[self.index], dtype=dtype)
+
+
+class SceneStack:
+    '''
+    (time, y, x[, band]) stack of scenes stored as memory-mapped .npy files or as one zarr array
+    '''
+    def __init__(self, scenes, names, zarr_array=None):
+        shapes = {scene.shape for scene in scenes}
+        if len(shapes) > 1:
+            raise ValueError('scenes of different shapes cannot be stacked: %s' % sorted(shapes))
+        self._scenes = scenes
+        self._zarr = zarr_array
+        self.names = list(names)
+        self.shape = (len(scenes),) + (scenes[0].shape if scenes else ())
+        self.ndim = len(self.shape)
+        self.dtype = scenes[0].dtype if scenes else None
+
+    @classmethod
+    def from_files(cls, paths):
+        # np.load with mmap_mode only reads the header of every file
+        names = [os.path.basename(path)[:-len('.npy')] for path in paths]
+        return cls([np.load(path, mmap_mode='r') for path in paths], names)
+
+    @classmethod
+    def from_folder(cls, folder, prefix):
+        return cls.from_files(find_scenes(folder, prefix))
+
+    @classmethod
+    def from_zarr(cls, path):
+        import zarr
+
+        array = zarr.open_array(path, mode='r')
+        return cls([_ZarrScene(array, i) for i in range(array.shape[0])], array.attrs['names'], array)
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __iter__(self):
+        return iter(self._scenes)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        '''
+        Numpy-style indexing; every axis is indexed independently (lists of bands or dates select those) and
+        only the selection is read
+        '''
+        key = key if isinstance(key, tuple) else (key,)
+        time, rest = key[0], key[1:]
+        if self._zarr is not None:
+            return self._zarr.oindex[key]
+        if isinstance(time, (int, np.integer)):
+            return _oindex(self._scenes[time], rest)
+        times = range(len(self))[time] if isinstance(time, slice) else time
+        if not len(times):
+            return _oindex(np.empty((0,) + self.shape[1:], dtype=self.dtype), (slice(None),) + rest)
+        return np.stack([_oindex(self._scenes[t], rest) for t in times])
+
+    def read(self, times=slice(None), window=(slice(None), slice(None)), bands=None):
+        '''
+        Array of the given dates (index, slice or list), spatial window (y slice, x slice) and bands (list or
+        None for all)
+        '''
+        key = (times,) + tuple(window)
+        if bands is not None:
+            key += (bands,)
+        return self[key]
+
+    def to_zarr(self, path, chunk_size=512):
+        '''
+        Write the stack to a zarr array at path (one chunk per date and chunk_size x chunk_size pixels, all
+        bands), scene by scene; returns the stack opened from the store
+        '''
+        import zarr
+
+        # the store is written next to path and moved in place once complete; the leftovers of an interrupted
+        # run and an existing store are removed
+        if os.path.exists(path + '.part'):
+            shutil.rmtree(path + '.part')
+        chunks = (1, chunk_size, chunk_size) + self.shape[3:]
+        array = zarr.open_array(path + '.part', mode='w', shape=self.shape, chunks=chunks, dtype=self.dtype)
+        for i, scene in enumerate(self._scenes):
+            array[i] = np.asarray(scene)
+        array.attrs['names'] = self.names
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(path + '.part', path)
+        return SceneStack.from_zarr(path)
+
+
+def open_stack(folder, prefix, store=None):
+    '''
+    Stack of the scenes of folder starting with prefix; with store (path of a zarr store), the combined store
+    is built on the first call and opened on later calls, and rebuilt when the scenes of folder changed
+    '''
+    paths = find_scenes(folder, prefix)
+    if store is not None and os.path.exists(store):
+        stack = SceneStack.from_zarr(store)
+        if stack.names == [os.path.basename(path)[:-len('.npy')] for path in paths]:
+            return stack
+    stack = SceneStack.from_files(paths)
+    return stack if store is None else stack.to_zarr(store)
@@ -0,0 +1,179 @@
+'''
+Vectorized Sentinel-2 indices of the Wildfires and burnt areas project (SCL mask, NDVI, VCI, NBR, dNBR)
+
+computeSCLMask, computeNDVI, computeVCI, computeFireMasks and the remap* functions of the project notebook
+visit every pixel in nested Python loops, and computeVCI builds a list of the history of every pixel. Here
+each index is a single array expression, the classes are assigned with np.digitize and the VCI reduces the
+NDVI history scene by scene with NaN-aware minimum / maximum, giving the same values as the notebook:
+
+    import wildfire_indices as wi
+    pre_mask, post_mask = wi.scl_mask(scl_fires_numpy[5]), wi.scl_mask(scl_fires_post_numpy[0])
+    ndvi = wi.ndvi(pre_fires_numpy[2], pre_mask)
+    vci = wi.vci(ndvi, [wi.ndvi(image, wi.scl_mask(scl)) for image, scl in zip(pre_fires_numpy, scl_fires_numpy)])
+    severity = wi.remap_dnbr(wi.dnbr(pre_fires_numpy[2], post_fires_numpy[0]))
+
+Images are (y, x, band) arrays with the 13 Sentinel-2 bands in the order of the project data. For full-size
+tiles, apply_blockwise runs any of these functions on blocks of rows of memory-mapped .npy files (or lists of
+them, for time series), writing to a memory-mapped output, so the memory use does not depend on the tile size.
+'''
+import numpy as np
+
+# band axis of the project images (B1, B2, B3, B4, B5, B6, B7, B8, B8A, B9, B10, B11, B12)
+RED = 3  # B4
+NIR = 7  # B8
+SWIR = 11  # B11, the shortwave infrared band of the NBR of computeFireMasks (the usual NBR uses B12)
+
+# scene classes masked out by computeSCLMask: no data, saturated, cloud shadows, clouds (medium and high
+# probability) and snow / ice
+SCL_MASKED = (0, 1, 3, 8, 9, 11)
+
+# upper bounds (inclusive) of the classes of remapNDVI and remapDNBR, class 1 is below the first bound
+NDVI_BOUNDS = (-0.2, 0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+DNBR_BOUNDS = (-0.251, -0.101, 0.099, 0.269, 0.439, 0.659, 1.3)
+
+
+def scl_mask(scl, classes=SCL_MASKED):
+    '''
+    True where the scene classification layer is one of classes (pixels to mask out), as computeSCLMask
+    '''
+    return np.isin(scl, classes)
+
+
+def _band(image, band):
+    # one band as float, before any arithmetic (unsigned integer reflectances would wrap around)
+    return np.asarray(image[..., band], dtype=float)
+
+
+def normalized_difference(image, band_a, band_b, mask=None):
+    '''
+    (a - b) / (a + b) of two bands of image; NaN where both bands are 0 or where mask is True
+    '''
+    a, b = _band(image, band_a), _band(image, band_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = (a - b) / (a + b)
+    invalid = (a == 0) & (b == 0)
+    if mask is not None:
+        invalid |= np.asarray(mask, dtype=bool)
+    index[invalid] = np.nan
+    return index
+
+
+def ndvi(image, mask=None):
+    '''
+    Normalized difference vegetation index (B8 - B4) / (B8 + B4), masked as computeNDVI
+    '''
+    return normalized_difference(image, NIR, RED, mask)
+
+
+def nbr(image, mask=None):
+    '''
+    Normalized burn ratio (B8 - B11) / (B8 + B11), with B11 as in computeFireMasks
+    '''
+    return normalized_difference(image, NIR, SWIR, mask)
+
+
+def dnbr(pre_fire, post_fire, pre_mask=None, post_mask=None):
+    '''
+    Difference of the pre-fire and post-fire NBR, as computeFireMasks
+    '''
+    return nbr(pre_fire, pre_mask) - nbr(post_fire, post_mask)
+
+
+def vci(ndvi, history):
+    '''
+    Vegetation condition index (NDVI - min) / (max - min) of ndvi, min and max taken over history and ndvi
+    itself (history: (time, y, x) array or list of scenes, NaN ignored). As computeVCI, the VCI is 1 where
+    ndvi is NaN, where fewer than two valid values exist or where max equals min.
+    '''
+    ndvi = np.asarray(ndvi, dtype=float)
+    lo, hi = ndvi.copy(), ndvi.copy()
+    count = (~np.isnan(ndvi)).astype(np.int32)
+    # one scene at a time: memory-mapped histories are read scene by scene and never stacked in memory
+    for scene in history:
+        scene = np.asarray(scene, dtype=float)
+        np.fmin(lo, scene, out=lo)
+        np.fmax(hi, scene, out=hi)
+        count += ~np.isnan(scene)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = (ndvi - lo) / (hi - lo)
+    return np.where((count > 1) & ~np.isnan(ndvi) & (hi != lo), index, 1.0)
+
+
+def remap(values, bounds):
+    '''
+    Class of every value: 1 up to bounds[0] (inclusive), i + 1 in (bounds[i - 1], bounds[i]], len(bounds) + 1
+    above the last bound; NaN stays NaN
+    '''
+    values = np.asarray(values, dtype=float)
+    classes = np.digitize(values, bounds, right=True) + 1.0
+    classes[np.isnan(values)] = np.nan
+    return classes
+
+
+def remap_ndvi(ndvi):
+    '''
+    NDVI classes 1-13 of remapNDVI
+    '''
+    return remap(ndvi, NDVI_BOUNDS)
+
+
+def remap_dnbr(dnbr):
+    '''
+    Burn severity classes 1-8 of remapDNBR
+    '''
+    return remap(dnbr, DNBR_BOUNDS)
+
+
+def remap_vci(vci):
+    '''
+    Drought classes of remapVCI: 1 below 0.35, 2 up to 0.5, 3 above (and for NaN)
+    '''
+    vci = np.asarray(vci, dtype=float)
+    return 3.0 - (vci < 0.35) - (vci <= 0.5)
+
+
+def _open(source):
+    # .npy files are memory-mapped, time series (lists, scene_stack.SceneStack) are opened scene by scene
+    if isinstance(source, (list, tuple)) or hasattr(source, 'names'):
+        return [_open(s) for s in source]
+    if isinstance(source, str):
+        return np.load(source, mmap_mode='r')
+    return source
+
+
+def _rows(source, start, stop):
+    if isinstance(source, list):
+        return [s[start:stop] for s in source]
+    if getattr(source, 'ndim', 0) >= 2:
+        return source[start:stop]
+    # scalars and None (e.g. no mask) are passed unchanged
+    return source
+
+
+def _shape(sources):
+    for source in sources:
+        source = source[0] if isinstance(source, list) else source
+        if getattr(source, 'ndim', 0) >= 2:
+            return source.shape[:2]
+    raise ValueError('no image among the inputs')
+
+
+def apply_blockwise(func, *sources, out=None, block_rows=512, dtype=np.float32):
+    '''
+    func(*sources) computed on blocks of block_rows rows, e.g. apply_blockwise(ndvi, 'pre_fire_1.npy', mask)
+    sources: (y, x, ...) arrays, .npy file names (memory-mapped), or lists of them and scene_stack.SceneStack
+    for time series (e.g. the history of vci); out: None (array in memory), a .npy file name (written as a
+    memory-mapped file) or an array. Only one block of every input is in memory at a time.
+    '''
+    sources = [_open(source) for source in sources]
+    shape = _shape(sources)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    for start in range(0, shape[0], block_rows):
+        stop = min(start + block_rows, shape[0])
+        out[start:stop] = func(*[_rows(source, start, stop) for source in sources])
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
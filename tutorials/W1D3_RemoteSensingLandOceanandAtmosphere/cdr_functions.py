@@ -0,0 +1,228 @@
+'''
+Bulk access to the NOAA Climate Data Record (CDR) files on AWS S3 used in the W1D3 tutorials
+
+Instead of globbing one date at a time and downloading every file whole through pooch_load:
+    - resolve_keys turns a date range into the object keys with a single listing
+    - fetch downloads them with a bounded pool of concurrent requests, skipping files that are already local
+    - fetch_subset reads only the requested variables / spatial window of each file through byte-range
+      requests and stores the (much smaller) subset locally
+    - build_zarr writes the files into one consolidated zarr store, which reopens in milliseconds
+
+Files are stored as <dest>/<bucket>/<key>, the same layout pooch_load uses with filename=<bucket>/<key>, so
+notebooks find files fetched in bulk and vice versa.
+
+Every function takes the file system as argument; s3_filesystem(endpoint_url=...) connects to a local S3
+stand-in (moto, minio) for testing.
+'''
+import os
+import json
+import shutil
+import re
+import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import xarray as xr
+
+shared_location = '/home/jovyan/shared/data/tutorials/W1D3_RemoteSensingLandOceanandAtmosphere'
+
+# S3 location of each product: files are partitioned in directories (partition, a strftime format) below
+# root, and the date of each file is parsed from its name with pattern / date_format
+PRODUCTS = {
+    'ndvi': {
+        'root': 'noaa-cdr-ndvi-pds/data',
+        'partition': '%Y',
+        'pattern': r'_(\d{8})_c\d+\.nc$',
+        'date_format': '%Y%m%d',
+    },
+    'gpcp_monthly': {
+        'root': 'noaa-cdr-precip-gpcp-monthly-pds/data',
+        'partition': '%Y',
+        'pattern': r'_d(\d{6})_c\d+\.nc$',
+        'date_format': '%Y%m',
+    },
+    'gpcp_daily': {
+        'root': 'noaa-cdr-precip-gpcp-daily-pds/data',
+        'partition': '%Y',
+        'pattern': r'_d(\d{8})_c\d+\.nc$',
+        'date_format': '%Y%m%d',
+    },
+    'oisst': {
+        'root': 'noaa-cdr-sea-surface-temp-optimum-interpolation-pds/data/v2.1/avhrr',
+        'partition': '%Y%m',
+        'pattern': r'\.(\d{8})(?:_preliminary)?\.nc$',
+        'date_format': '%Y%m%d',
+    },
+}
+
+
+def s3_filesystem(endpoint_url=None, anon=True):
+    '''
+    Anonymous S3 file system; endpoint_url (or $AWS_ENDPOINT_URL) points it to a local S3 stand-in
+    '''
+    import s3fs
+
+    endpoint_url = endpoint_url or os.environ.get('AWS_ENDPOINT_URL')
+    client_kwargs = {'endpoint_url': endpoint_url} if endpoint_url else {}
+    return s3fs.S3FileSystem(anon=anon, client_kwargs=client_kwargs)
+
+
+def default_dest():
+    '''
+    The shared data directory on the JupyterHub if it exists, the temporary directory otherwise (as pooch_load)
+    '''
+    return shared_location if os.path.isdir(shared_location) else tempfile.gettempdir()
+
+
+def _to_datetime(date):
+    if isinstance(date, str):
+        return datetime.datetime.fromisoformat(date)
+    return datetime.datetime(date.year, date.month, date.day)
+
+
+def _listing_prefix(spec, start, end):
+    # deepest directory that contains every partition between start and end
+    first, last = start.strftime(spec['partition']), end.strftime(spec['partition'])
+    if first == last:
+        return spec['root'] + '/' + first
+    return spec['root']
+
+
+def resolve_keys(fs, product, start, end):
+    '''
+    Return the sorted [(date, key)] of a product between start and end (inclusive, datetime or ISO string)
+    All keys come from a single recursive listing. When a date has several files (reprocessed versions),
+    the latest one is kept.
+    '''
+    spec = PRODUCTS[product] if isinstance(product, str) else product
+    start, end = _to_datetime(start), _to_datetime(end)
+    pattern = re.compile(spec['pattern'])
+
+    files = {}
+    for key in sorted(fs.find(_listing_prefix(spec, start, end))):
+        match = pattern.search(key)
+        if match is None:
+            continue
+        date = datetime.datetime.strptime(match.group(1), spec['date_format'])
+        if start <= date <= end:
+            files[date] = key  # keys are sorted, so later versions replace earlier ones
+    return sorted(files.items())
+
+
+def local_path(key, dest):
+    return os.path.join(dest, *key.split('/'))
+
+
+def _remote_size(fs, key):
+    try:
+        return fs.info(key)['size']
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+def _fetch_one(fs, key, dest):
+    path = local_path(key, dest)
+    # the size is only looked up (one request, in the worker thread) to check a file that is already there
+    if os.path.exists(path):
+        size = _remote_size(fs, key)
+        if size is None or os.path.getsize(path) == size:
+            return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.part'
+    fs.get_file(key, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def fetch(fs, keys, dest=None, n_jobs=8):
+    '''
+    Download keys into dest (see default_dest) with at most n_jobs concurrent requests
+    Files that are already present with the right size are not downloaded again. Returns the local paths
+    in the order of keys.
+    '''
+    dest = dest or default_dest()
+    keys = [key[1] if isinstance(key, tuple) else key for key in keys]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(lambda key: _fetch_one(fs, key, dest), keys))
+
+
+def _subset(ds, variables=None, window=None):
+    if variables is not None:
+        ds = ds[list(variables)]
+    if window is not None:
+        ds = ds.sel(**{dim: slice(*bounds) for dim, bounds in window.items()})
+    return ds
+
+
+def _subset_name(key, variables, window):
+    tag = '_'.join(sorted(variables or []))
+    if window is not None:
+        tag += '_' + '_'.join('%s%g-%g' % (dim, *bounds) for dim, bounds in sorted(window.items()))
+    return key[:-len('.nc')] + ('.' + tag if tag else '') + '.nc'
+
+
+def _fetch_subset_one(fs, key, dest, variables, window):
+    path = local_path(_subset_name(key, variables, window), dest)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # h5netcdf reads the HDF5 metadata and the chunks of the selected data through ranged GET requests
+    with fs.open(key, 'rb', block_size=2**20, cache_type='readahead') as f:
+        with xr.open_dataset(f, engine='h5netcdf') as ds:
+            ds = _subset(ds, variables, window).load()
+    ds.to_netcdf(path + '.part', engine='h5netcdf')
+    os.replace(path + '.part', path)
+    return path
+
+
+def fetch_subset(fs, keys, variables=None, window=None, dest=None, n_jobs=8):
+    '''
+    Like fetch, but only read the given variables and spatial window, e.g.
+    window={'latitude': (-10, 10), 'longitude': (180, 280)} (slices in the file's own coordinate order)
+    Only the byte ranges holding those data are requested. Returns the local paths of the subsets.
+    '''
+    dest = dest or default_dest()
+    keys = [key[1] if isinstance(key, tuple) else key for key in keys]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(lambda key: _fetch_subset_one(fs, key, dest, variables, window), keys))
+
+
+def build_zarr(paths, store, concat_dim='time', chunks=None):
+    '''
+    Concatenate local netCDF files along concat_dim into one consolidated zarr store and open it
+    The store records the files it was built from (their names encode the variables and window of subsets)
+    and is only written again when they change, reopening it is nearly instant.
+    '''
+    sources = json.dumps([os.path.basename(path) for path in paths] + [concat_dim, chunks], sort_keys=True)
+    if os.path.exists(store):
+        ds = xr.open_zarr(store, consolidated=True)
+        if ds.attrs.get('cdr_sources') == sources:
+            return ds
+        ds.close()
+        shutil.rmtree(store)
+    if os.path.exists(store + '.part'):
+        shutil.rmtree(store + '.part')
+    with xr.open_mfdataset(paths, combine='nested', concat_dim=concat_dim, parallel=True) as ds:
+        if chunks is not None:
+            ds = ds.chunk(chunks)
+        ds.attrs['cdr_sources'] = sources
+        ds.to_zarr(store + '.part', consolidated=True, mode='w')
+    os.replace(store + '.part', store)
+    return xr.open_zarr(store, consolidated=True)
+
+
+def open_cdr(product, start, end, variables=None, window=None, fs=None, dest=None, n_jobs=8, store=None):
+    '''
+    Open a product between start and end as one dataset: resolve the keys, fetch the files (or only their
+    subsets if variables or window are given) in parallel and, if store is given, consolidate them into a
+    zarr store for fast repeated opens
+    '''
+    fs = fs or s3_filesystem()
+    keys = resolve_keys(fs, product, start, end)
+    if variables is not None or window is not None:
+        paths = fetch_subset(fs, keys, variables, window, dest, n_jobs)
+    else:
+        paths = fetch(fs, keys, dest, n_jobs)
+    if store is not None:
+        return build_zarr(paths, store)
+    return xr.open_mfdataset(paths, combine='nested', concat_dim='time')
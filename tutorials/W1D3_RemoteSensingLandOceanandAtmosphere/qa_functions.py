@@ -0,0 +1,172 @@
+'''
+Decoding of bit-packed quality flags (QA variables) of satellite products
+
+Each product has a declarative bit specification (QA_FLAGS: name -> bit or (first bit, number of bits)) and
+named rules (QA_RULES: name -> {flag: required value}). A rule is compiled into a single bit mask and
+expected value, so checking any number of flags costs one bitwise_and and one comparison per pixel, instead
+of the modulo / integer division temporaries of get_quality_info in W1D3 Tutorial 3.
+
+All functions accept numpy arrays, dask arrays and xarray DataArrays. Dask-backed data are processed block by
+block, and masked() applies the quality mask inside the same blockwise task that reads the data, so no
+full-resolution mask is ever held in memory.
+'''
+import numpy as np
+import xarray as xr
+
+# bit layout of the QA variables, see the QA table in W1D3 Tutorial 3
+QA_FLAGS = {
+    'ndvi_cdr': {
+        'cloud': 1,
+        'cloud_shadow': 2,
+        'water': 3,
+        'sunglint': 4,
+        'dense_dark_vegetation': 5,
+        'night': 6,
+        'channels_valid': 7,
+        'channel1_invalid': 8,
+        'channel2_invalid': 9,
+        'channel3_invalid': 10,
+        'channel4_invalid': 11,
+        'channel5_invalid': 12,
+        'rh03_invalid': 13,
+        'brdf_issue': 14,
+        'polar': 15,
+    },
+}
+
+QA_RULES = {
+    'ndvi_cdr': {
+        # same criteria as get_quality_info in W1D3 Tutorial 3
+        'high_quality': {'channels_valid': 1, 'cloud': 0, 'cloud_shadow': 0},
+        'clear': {'cloud': 0, 'cloud_shadow': 0},
+        'clear_land': {'cloud': 0, 'cloud_shadow': 0, 'water': 0},
+    },
+}
+
+
+def _field(spec):
+    # (first bit, number of bits) of a flag specification
+    return (spec, 1) if isinstance(spec, int) else tuple(spec)
+
+
+def compile_rule(product, rule):
+    '''
+    Turn a rule (name in QA_RULES or dict {flag: value}) into (bit mask, expected value) such that
+    (qa & bit mask) == expected value exactly for the pixels that satisfy the rule
+    '''
+    flags = QA_FLAGS[product]
+    if isinstance(rule, str):
+        rule = QA_RULES[product][rule]
+    and_mask = 0
+    expected = 0
+    for name, value in rule.items():
+        bit, width = _field(flags[name])
+        if not 0 <= value < 2**width:
+            raise ValueError('value %i does not fit in the %i bit(s) of flag %s' % (value, width, name))
+        and_mask |= (2**width - 1) << bit
+        expected |= value << bit
+    return and_mask, expected
+
+
+def _as_bits(qa):
+    # integer view of a QA block; QA read with mask_and_scale is float with NaN for missing values
+    if np.issubdtype(qa.dtype, np.floating):
+        valid = ~np.isnan(qa)
+        return np.where(valid, qa, 0).astype(np.int64), valid
+    return qa, None
+
+
+def _match_block(qa, and_mask, expected):
+    bits, valid = _as_bits(qa)
+    match = np.bitwise_and(bits, and_mask) == expected
+    if valid is not None:
+        match &= valid
+    return match
+
+
+def _masked_block(data, qa, and_mask, expected, fill_value):
+    return np.where(_match_block(qa, and_mask, expected), data, fill_value)
+
+
+def _apply(func, *args, output_dtype):
+    # run func blockwise on numpy, dask or xarray inputs
+    if isinstance(args[0], xr.DataArray):
+        return xr.apply_ufunc(func, *args, dask='parallelized', output_dtypes=[output_dtype])
+    if hasattr(args[0], 'map_blocks'):
+        import dask.array as da
+        return da.map_blocks(func, *args, dtype=output_dtype)
+    return func(*args)
+
+
+def quality_mask(qa, product='ndvi_cdr', rule='high_quality'):
+    '''
+    Boolean mask of the pixels whose QA satisfies rule (True: keep), same shape and type as qa
+    '''
+    and_mask, expected = compile_rule(product, rule)
+    return _apply(lambda block: _match_block(block, and_mask, expected), qa, output_dtype=bool)
+
+
+def masked(data, qa, product='ndvi_cdr', rule='high_quality', fill_value=np.nan):
+    '''
+    data where the QA satisfies rule, fill_value elsewhere; the mask is computed and applied per block
+    For NDVI: masked(ds.NDVI, ds.QA) is the same as ds.NDVI.where(get_quality_info(ds.QA))
+    '''
+    and_mask, expected = compile_rule(product, rule)
+    dtype = np.result_type(data.dtype, np.min_scalar_type(fill_value))
+
+    def func(data_block, qa_block):
+        return _masked_block(data_block, qa_block, and_mask, expected, fill_value)
+
+    return _apply(func, data, qa, output_dtype=dtype)
+
+
+def decode_flags(qa, product='ndvi_cdr', names=None):
+    '''
+    Value of every flag (or of the given names) as a dict of uint8 arrays, for inspecting a QA variable
+    '''
+    flags = QA_FLAGS[product]
+    out = {}
+    for name in names or flags:
+        bit, width = _field(flags[name])
+
+        def func(block, bit=bit, width=width):
+            bits, _ = _as_bits(block)
+            return (np.right_shift(bits, bit) & (2**width - 1)).astype(np.uint8)
+
+        out[name] = _apply(func, qa, output_dtype=np.uint8)
+    return out
+
+
+def pack_mask(mask):
+    '''
+    Pack a boolean numpy, dask or xarray mask 8 pixels per byte along its last axis (np.packbits)
+    For dask arrays, every chunk but the last along that axis must be a multiple of 8 pixels. A DataArray
+    keeps its other coordinates, its last dimension becomes <dim>_packed (length recorded in the attrs).
+    '''
+    if isinstance(mask, xr.DataArray):
+        dim = mask.dims[-1]
+        coords = {name: c for name, c in mask.coords.items() if dim not in c.dims}
+        return xr.DataArray(pack_mask(mask.data), dims=mask.dims[:-1] + (dim + '_packed',), coords=coords,
+                            name=mask.name, attrs={'packed_dim': dim, 'packed_size': mask.shape[-1]})
+    if hasattr(mask, 'map_blocks'):
+        import dask.array as da
+
+        last = mask.chunks[-1]
+        if any(c % 8 for c in last[:-1]):
+            raise ValueError('chunks along the last axis must be multiples of 8, got %s' % (last,))
+        chunks = mask.chunks[:-1] + (tuple((c + 7) // 8 for c in last),)
+        return da.map_blocks(np.packbits, mask, axis=-1, dtype=np.uint8, chunks=chunks)
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, n=None):
+    '''
+    Inverse of pack_mask: n is the length of the last axis of the original mask (recorded by DataArrays)
+    '''
+    if isinstance(packed, xr.DataArray):
+        n = packed.attrs['packed_size'] if n is None else n
+        return xr.DataArray(unpack_mask(np.asarray(packed.data), n),
+                            dims=packed.dims[:-1] + (packed.attrs['packed_dim'],),
+                            coords={name: c for name, c in packed.coords.items() if packed.dims[-1] not in c.dims},
+                            name=packed.name)
+    return np.unpackbits(packed, axis=-1, count=n).astype(bool)
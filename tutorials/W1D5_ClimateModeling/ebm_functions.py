@@ -0,0 +1,181 @@
+'''
+Vectorized zero-dimensional energy balance model (EBM) of W1D5 Tutorials 2-4
+
+    C dT/dt = ASR - OLR + F = (1 - alpha) Q - tau sigma T^4 + F(t)
+
+The tutorials advance one scenario at a time with step_forward / step_forward_forced and Python lists. Here
+every parameter (T0, alpha, tau, C, Q, F) may be an array: they are broadcast against each other into a
+scenario axis (or grid, e.g. alpha[:, None] and tau[None, :] for a sensitivity map) and all scenarios are
+integrated together with NumPy, e.g.
+
+    import ebm_functions as ebm
+    t, T = ebm.integrate(288, alpha=0.2941, tau=np.linspace(0.55, 0.65, 1000)[:, None], n_steps=50)
+    T_eq = ebm.get_eqT(tau=np.linspace(0.01, 1, 100), alpha=0.2941)
+
+alpha may also be a function of T, such as albedo_ramp (ice-albedo feedback of Tutorial 4).
+'''
+import numpy as np
+
+sigma = 5.67e-8  # Stefan-Boltzmann constant, W m^-2 K^-4
+Q = 340  # insolation, W m^-2 (IPCC AR6 Figure 7.2)
+C = 286471954.64  # heat capacity of the upper ocean, J m^-2 K^-1 (Tutorial 3)
+dt_year = 60.0 * 60.0 * 24.0 * 365.0  # one year in seconds
+sec_2_yr = 3.154e7
+
+
+def albedo_ramp(T):
+    '''
+    Temperature dependent albedo of Tutorial 4: 0.7 below 240 K (ice), 0.1 above 300 K (ice free), quadratic
+    in between
+    '''
+    T = np.asarray(T, dtype=float)
+    ramp = 0.1 + (0.7 - 0.1) * (T - 300) ** 2 / (240 - 300) ** 2
+    return np.where(T >= 300, 0.1, np.where(T > 240, ramp, 0.7))
+
+
+def ASR(alpha, Q, T=None):
+    '''
+    Absorbed shortwave radiation (1 - alpha) Q; alpha may be a function of T
+    '''
+    if callable(alpha):
+        alpha = alpha(T)
+    return (1 - alpha) * Q
+
+
+def OLR(tau, T):
+    '''
+    Outgoing longwave radiation tau sigma T^4
+    '''
+    return tau * sigma * T**4
+
+
+def Ftoa(T, alpha, tau, Q=Q, F=0):
+    '''
+    Net energy flux at the top of the atmosphere, W m^-2
+    '''
+    return ASR(alpha, Q, T) + F - OLR(tau, T)
+
+
+def get_eqT(tau, alpha=100 / 340, Q=Q, F=0):
+    '''
+    Equilibrium temperature ((ASR + F) / (tau sigma))^(1/4) for arrays of any of the parameters
+    (constant alpha; see equilibria for a temperature dependent albedo)
+    '''
+    tau = np.asarray(tau, dtype=float)
+    with np.errstate(divide='ignore'):
+        return ((ASR(alpha, Q) + F) / (tau * sigma)) ** 0.25
+
+
+def _scenario_shape(*params):
+    # broadcast shape of the parameters; functions (alpha(T), F(t)) do not add axes, forcing arrays contribute
+    # their scenario axes (after the time axis)
+    shapes = []
+    for name, value in params:
+        if callable(value):
+            continue
+        value = np.asarray(value)
+        shapes.append(value.shape[1:] if name == 'F' and value.ndim else value.shape)
+    return np.broadcast_shapes(*shapes)
+
+
+def equilibria(alpha, tau, Q=Q, F=0, T_min=150.0, T_max=400.0, n_grid=501, n_bisect=40):
+    '''
+    All equilibrium temperatures between T_min and T_max, for a temperature dependent albedo (several
+    equilibria, as with brentq in Tutorial 4). Returns an array (n_roots, *scenario shape), NaN where a
+    scenario has fewer roots. Roots are bracketed on a grid of n_grid temperatures and refined by bisection,
+    for all scenarios at once.
+    '''
+    n_axes = len(_scenario_shape(('alpha', alpha), ('tau', tau), ('Q', Q), ('F0', F)))
+    grid = np.linspace(T_min, T_max, n_grid).reshape((-1,) + (1,) * n_axes)
+    flux = Ftoa(grid, alpha, tau, Q, F)
+    sign_change = np.signbit(flux[:-1]) != np.signbit(flux[1:])
+    n_roots = sign_change.sum(axis=0)
+    roots = np.full((max(1, n_roots.max()),) + flux.shape[1:], np.nan)
+    # k-th bracket of every scenario
+    order = np.cumsum(sign_change, axis=0)
+    for k in range(roots.shape[0]):
+        first = sign_change & (order == k + 1)
+        if not first.any():
+            continue
+        index = np.argmax(first, axis=0)
+        found = first.any(axis=0)
+        lo = np.take_along_axis(np.broadcast_to(grid, flux.shape), index[None], 0)[0]
+        hi = lo + (T_max - T_min) / (n_grid - 1)
+        f_lo = Ftoa(lo, alpha, tau, Q, F)
+        for _ in range(n_bisect):
+            mid = 0.5 * (lo + hi)
+            f_mid = Ftoa(mid, alpha, tau, Q, F)
+            left = np.signbit(f_mid) != np.signbit(f_lo)
+            hi = np.where(left, mid, hi)
+            lo, f_lo = np.where(left, lo, mid), np.where(left, f_lo, f_mid)
+        roots[k] = np.where(found, 0.5 * (lo + hi), np.nan)
+    return roots
+
+
+def _forcing(F, t, n):
+    # forcing at step n: constant, array over time (first axis) or function of time in years
+    if callable(F):
+        return F(t)
+    F = np.asarray(F, dtype=float)
+    return F if F.ndim == 0 else F[min(n, F.shape[0] - 1)]
+
+
+def _linear_feedback(T, alpha, tau, Q):
+    # -dFtoa/dT, the rate at which the flux restores T (numerical derivative for a T-dependent albedo)
+    lam = 4 * tau * sigma * T**3
+    if callable(alpha):
+        h = 1e-3
+        lam = lam - (ASR(alpha, Q, T + h) - ASR(alpha, Q, T - h)) / (2 * h)
+    return lam
+
+
+def _step(T, t, n, alpha, tau, C, Q, F, dt, method):
+    if method == 'euler':
+        return T + dt / C * Ftoa(T, alpha, tau, Q, _forcing(F, t, n))
+    if method == 'rk4':
+        F0, F1 = _forcing(F, t, n), _forcing(F, t + dt / sec_2_yr, n + 1)
+        Fh = 0.5 * (F0 + F1)
+        k1 = Ftoa(T, alpha, tau, Q, F0) / C
+        k2 = Ftoa(T + 0.5 * dt * k1, alpha, tau, Q, Fh) / C
+        k3 = Ftoa(T + 0.5 * dt * k2, alpha, tau, Q, Fh) / C
+        k4 = Ftoa(T + dt * k3, alpha, tau, Q, F1) / C
+        return T + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    if method == 'exponential':
+        # exponential integrator of the linearized flux: exact relaxation towards the local equilibrium,
+        # stable for any dt where the feedback restores T (T + G / lam (1 - exp(-lam dt / C))). Where it
+        # amplifies T (lam < 0, e.g. near the unstable equilibrium of albedo_ramp) exp(-lam dt / C) grows
+        # without bound, so the step falls back to Euler there
+        G = Ftoa(T, alpha, tau, Q, _forcing(F, t, n))
+        z = np.maximum(_linear_feedback(T, alpha, tau, Q) * dt / C, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            phi = np.where(np.abs(z) > 1e-8, -np.expm1(-z) / z, 1.0)
+        return T + dt / C * G * phi
+    raise ValueError('unknown method %s, use euler, rk4 or exponential' % method)
+
+
+def integrate(T0, alpha=0.2941, tau=0.6127, C=C, Q=Q, F=0, dt=dt_year, n_steps=100, method='euler',
+              tol=None, series=True):
+    '''
+    Integrate the EBM for all scenarios (the broadcast shape of T0, alpha, tau, C, Q and F) at once
+    F: constant, array over time (first axis, one value per step, scenario axes after) or function F(t years)
+    method: 'euler' (as step_forward in the tutorials), 'rk4', or 'exponential' (stable for large dt
+    where the feedback is negative)
+    tol: stop early once |dT| < tol K per step in every scenario (equilibrium)
+    Returns (t in years, T) with T of shape (steps + 1, *scenarios), or only the last T if not series.
+    '''
+    shape = _scenario_shape(('T0', T0), ('alpha', alpha), ('tau', tau), ('C', C), ('Q', Q), ('F', F))
+    T = np.broadcast_to(np.asarray(T0, dtype=float), shape).copy()
+    history = [T] if series else None
+    t = 0.0
+    n = -1
+    for n in range(n_steps):
+        T_new = _step(T, t, n, alpha, tau, C, Q, F, dt, method)
+        t += dt / sec_2_yr
+        if series:
+            history.append(T_new)
+        converged = tol is not None and np.all(np.abs(T_new - T) < tol)
+        T = T_new
+        if converged:
+            break
+    times = np.arange(len(history) if series else n + 2) * dt / sec_2_yr
+    return (times, np.stack(history)) if series else (times[-1], T)
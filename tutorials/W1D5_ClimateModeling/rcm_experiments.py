@@ -0,0 +1,170 @@
+'''
+Parallel, cached climlab column model experiments (W1D5 Tutorials 5-6)
+
+The tutorials build an RRTMG radiation model (optionally coupled to convective adjustment), clone it with
+climlab.process_like for every perturbation (no water vapor, doubled CO2, ...) and step each clone to
+equilibrium in a Python loop. Here an experiment is a plain dict of changes to a base configuration:
+
+    import rcm_experiments as rcm
+    base = rcm.base_config(Qglobal, adj_lapse_rate=6.5)
+    results = rcm.run_experiments({'control': {}, 'noH2O': {'h2o_scale': 0}, '2xCO2': {'CO2': 2 * 348e-6},
+                                   'albedo0.3': {'albedo': 0.3}}, base)
+    results['2xCO2'].Tatm, results['2xCO2'].OLR          # equilibrium state and diagnostics (xarray)
+    model = rcm.load_model(results['2xCO2'])             # climlab model in that state, e.g. for add_profile
+
+Experiments run in a process pool until the top of atmosphere imbalance |ASR - OLR| falls below tol. Every
+equilibrium (state and climlab.to_xarray(diagnostics)) is stored as netCDF under a hash of its configuration,
+so repeating an experiment, in any notebook, only reads the file.
+'''
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+GASES = ('CO2', 'CH4', 'N2O', 'O2', 'O3', 'CFC11', 'CFC12', 'CFC22', 'CCL4')
+
+DEFAULTS = {
+    'name': 'Radiation (all gases)',
+    'albedo': 0.25,  # surface shortwave albedo
+    'water_depth': 2.5,
+    'timestep_days': 1.0,
+    'h2o_scale': 1.0,  # factor applied to the specific humidity profile
+    'adj_lapse_rate': None,  # K/km, couples convective adjustment to the radiation when given
+}
+
+
+def cache_dir():
+    '''
+    Directory of the cached equilibria: $CMA_RCM_DIR, else ~/.cache/climatematch/rcm
+    '''
+    return os.environ.get('CMA_RCM_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climatematch', 'rcm'))
+
+
+def base_config(Qglobal, **kwargs):
+    '''
+    Base configuration on the levels of the specific humidity profile Qglobal (as in the tutorials); kwargs
+    override DEFAULTS or set gas volume mixing ratios (e.g. CO2=280e-6)
+    '''
+    config = dict(DEFAULTS, lev=[float(p) for p in Qglobal['lev'].values],
+                  specific_humidity=[float(q) for q in np.asarray(Qglobal)])
+    config.update(kwargs)
+    return config
+
+
+def _to_json(value):
+    # numpy values of a configuration (e.g. an O3 profile) as JSON lists and numbers
+    return np.asarray(value).tolist()
+
+
+def config_key(config):
+    '''
+    Hash identifying a configuration (the name is not part of it)
+    '''
+    items = {key: value for key, value in config.items() if key != 'name'}
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=_to_json).encode()).hexdigest()
+
+
+def build_model(config):
+    '''
+    climlab model of a configuration: RRTMG, coupled to ConvectiveAdjustment if adj_lapse_rate is set
+    '''
+    import climlab
+
+    state = climlab.column_state(lev=np.array(config['lev']), water_depth=config['water_depth'])
+    timestep = config['timestep_days'] * climlab.constants.seconds_per_day
+    rad = climlab.radiation.RRTMG(name='Radiation', state=state,
+                                  specific_humidity=np.array(config['specific_humidity']) * config['h2o_scale'],
+                                  albedo=config['albedo'], timestep=timestep)
+    for gas in GASES:
+        if gas in config:
+            rad.absorber_vmr[gas] = config[gas]
+    if config['adj_lapse_rate'] is None:
+        rad.name = config['name']
+        return rad
+    conv = climlab.convection.ConvectiveAdjustment(name='Convection', state=state,
+                                                   adj_lapse_rate=config['adj_lapse_rate'], timestep=timestep)
+    return climlab.couple([rad, conv], name=config['name'])
+
+
+def run_to_equilibrium(model, tol=0.01, max_steps=20000, record_every=None):
+    '''
+    Step model forward until |ASR - OLR| < tol W m^-2 (or max_steps); returns (steps, converged, Tatm history)
+    With record_every, the atmospheric temperature is kept every record_every steps (for animations).
+    '''
+    history = []
+    model.step_forward()
+    steps = 1
+    while np.abs(model.ASR - model.OLR) > tol and steps < max_steps:
+        if record_every and steps % record_every == 0:
+            history.append(np.array(model.Tatm))
+        model.step_forward()
+        steps += 1
+    return steps, bool(np.abs(model.ASR - model.OLR) <= tol), history
+
+
+def _run(args):
+    config, tol, max_steps, record_every = args
+    import climlab
+
+    model = build_model(config)
+    steps, converged, history = run_to_equilibrium(model, tol, max_steps, record_every)
+    ds = xr.merge([climlab.to_xarray(model.state), climlab.to_xarray(model.diagnostics)], compat='override')
+    if history:
+        ds['Tatm_history'] = (('record', ds.Tatm.dims[-1]), np.array(history).reshape(len(history), -1))
+    ds.attrs.update(config=json.dumps(config, default=_to_json), steps=steps, converged=int(converged))
+    return ds
+
+
+def _cache_file(config, tol, record_every):
+    key = config_key(dict(config, tol=tol, record_every=record_every))
+    return os.path.join(cache_dir(), key + '.nc')
+
+
+def run_experiments(experiments, base, tol=0.01, max_steps=20000, record_every=None, n_jobs=None, cache=True):
+    '''
+    Run every experiment ({name: changes to base}) to equilibrium, in parallel, and return {name: Dataset of
+    the equilibrium state and diagnostics}. Equilibria already in the cache are read instead of computed;
+    runs that did not converge within max_steps are returned but not cached.
+    '''
+    configs = {name: dict(base, name=name, **changes) for name, changes in experiments.items()}
+    files = {name: _cache_file(config, tol, record_every) for name, config in configs.items()}
+    todo = [name for name in configs if not (cache and os.path.exists(files[name]))]
+
+    if todo:
+        print('Running %i of %i experiments' % (len(todo), len(configs)))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(_run, [(configs[name], tol, max_steps, record_every) for name in todo])
+            for name, ds in zip(todo, results):
+                if not ds.attrs['converged']:
+                    print('%s did not converge in %i steps' % (name, max_steps))
+                # an unconverged state is not an equilibrium: a later call (e.g. with more steps) runs it again
+                if cache and ds.attrs['converged']:
+                    os.makedirs(cache_dir(), exist_ok=True)
+                    ds.to_netcdf(files[name] + '.part', format='NETCDF4')
+                    os.replace(files[name] + '.part', files[name])
+                else:
+                    files[name] = ds
+
+    out = {}
+    for name in configs:
+        if isinstance(files[name], xr.Dataset):
+            out[name] = files[name]
+        else:
+            with xr.open_dataset(files[name]) as ds:
+                out[name] = ds.load()
+    return out
+
+
+def load_model(result):
+    '''
+    climlab model of a result of run_experiments, set to its equilibrium state (no time stepping needed)
+    '''
+    model = build_model(json.loads(result.attrs['config']))
+    for name in model.state:
+        if name in result:
+            model.state[name][:] = result[name].values.reshape(np.shape(model.state[name]))
+    model.compute_diagnostics()
+    return model
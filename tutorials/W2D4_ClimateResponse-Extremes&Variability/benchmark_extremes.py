@@ -0,0 +1,258 @@
+'''
+Offline benchmark suite for the extremes helpers in gev_functions and extremes_functions
+
+Runs on synthetic GEV/GPD data (no downloads) and records, for every case:
+    - wall time (seconds)
+    - peak traced memory (MB)
+    - accuracy against a reference fit done directly with scipy.stats
+
+Usage (from this directory):
+    python benchmark_extremes.py                         # default cases
+    python benchmark_extremes.py --grids 10x10,45x90,180x360 --output bench.json
+    python benchmark_extremes.py --baseline bench.json   # fail if slower than a previous run
+
+SDFC is optional: if it cannot be imported, the extremes_functions cases are skipped.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import contextlib
+import io
+
+import numpy as np
+import xarray as xr
+from scipy.stats import genextreme as gev
+from scipy.stats import genpareto as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gev_functions as gf
+
+try:
+    import extremes_functions as ef
+except ImportError:
+    ef = None
+
+# true parameters of the synthetic data, SDFC/Coles sign convention for the shape
+GEV_PARAMS = {'loc': 30., 'scale': 8., 'shape': 0.1}
+GPD_PARAMS = {'threshold': 20., 'scale': 5., 'shape': 0.1}
+RETURN_PERIODS = np.array([2., 5., 10., 20., 50., 100.])
+MEASURE_MEMORY = True
+
+
+def synthetic_gev(size, seed=0):
+    '''
+    Draw GEV distributed annual maxima, shape in Coles convention (scipy uses c = -shape)
+    '''
+    rng = np.random.default_rng(seed)
+    p = GEV_PARAMS
+    return gev.rvs(-p['shape'], loc=p['loc'], scale=p['scale'], size=size, random_state=rng)
+
+
+def synthetic_gpd(size, exceedance_rate=0.1, seed=0):
+    '''
+    Daily-like series whose values above the threshold follow a GPD
+    '''
+    rng = np.random.default_rng(seed)
+    p = GPD_PARAMS
+    data = rng.uniform(0, p['threshold'], size=size)
+    exceed = rng.random(size) < exceedance_rate
+    data[exceed] = p['threshold'] + gpd.rvs(p['shape'], scale=p['scale'], size=exceed.sum(), random_state=rng)
+    return data
+
+
+def synthetic_grid(nlat, nlon, ntime=50, seed=0):
+    '''
+    Gridded (time, latitude, longitude) GEV maxima as DataArray
+    '''
+    data = synthetic_gev(ntime * nlat * nlon, seed=seed).reshape(ntime, nlat, nlon)
+    return xr.DataArray(
+        dims=['time', 'latitude', 'longitude'],
+        coords={
+            'time': np.arange(ntime),
+            'latitude': np.linspace(-89.5, 89.5, nlat),
+            'longitude': np.linspace(0.5, 359.5, nlon),
+        },
+        data=data, name='pr', attrs={'units': 'mm/day'})
+
+
+def reference_gev_levels(data, periods):
+    '''
+    Return levels from a direct scipy GEV fit
+    '''
+    c, loc, scale = gev.fit(data)
+    return gev.ppf(1 - 1 / periods, c, loc=loc, scale=scale)
+
+
+def reference_gpd_levels(data, threshold, periods, periods_per_year):
+    '''
+    Return levels from a direct scipy GPD fit to the exceedances, Coles 2001 Eq. 4.13
+    '''
+    exceedances = data[data > threshold] - threshold
+    zeta_u = exceedances.size / data.size
+    shape, _, scale = gpd.fit(exceedances, floc=0)
+    return threshold + scale / shape * ((periods * periods_per_year * zeta_u)**shape - 1)
+
+
+def max_rel_error(levels, reference):
+    levels = np.asarray(levels, dtype=float)
+    reference = np.asarray(reference, dtype=float)
+    return float(np.nanmax(np.abs(levels - reference) / np.abs(reference)))
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Run func, return (result, wall time in s, peak traced memory in MB); stdout is silenced
+    Timing and memory are taken from separate runs since tracemalloc slows down allocations.
+    Set MEASURE_MEMORY = False to skip the second run.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        peak = np.nan
+        if MEASURE_MEMORY:
+            tracemalloc.start()
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+def bench_single_series(n_years=100):
+    data = synthetic_gev(n_years)
+    daily = synthetic_gpd(365 * n_years)
+    out = []
+
+    res, t, mem = measure(gf.empirical_return_level, data)
+    out.append({'case': 'gf.empirical_return_level', 'size': n_years, 'time': t, 'peak_mb': mem,
+                'max_rel_error': max_rel_error(res.values, np.sort(data))})
+
+    res, t, mem = measure(gf.fit_return_levels, data, RETURN_PERIODS)
+    out.append({'case': 'gf.fit_return_levels', 'size': n_years, 'time': t, 'peak_mb': mem,
+                'max_rel_error': max_rel_error(res['GEV'], reference_gev_levels(data, RETURN_PERIODS))})
+
+    if ef is not None:
+        res, t, mem = measure(ef.return_period_obs, daily, 365, threshold=GPD_PARAMS['threshold'])
+        expected = np.sort(daily[daily > GPD_PARAMS['threshold']])
+        out.append({'case': 'ef.return_period_obs', 'size': daily.size, 'time': t, 'peak_mb': mem,
+                    'max_rel_error': max_rel_error(res.values, expected)})
+
+        res, t, mem = measure(ef.fit_return_levels_sdfc, data, RETURN_PERIODS, 1, 'GEV')
+        out.append({'case': 'ef.fit_return_levels_sdfc (GEV)', 'size': n_years, 'time': t, 'peak_mb': mem,
+                    'max_rel_error': max_rel_error(res, reference_gev_levels(data, RETURN_PERIODS))})
+
+        res, t, mem = measure(ef.fit_return_levels_sdfc, daily, RETURN_PERIODS, 365, 'GPD',
+                              f_loc=GPD_PARAMS['threshold'])
+        reference = reference_gpd_levels(daily, GPD_PARAMS['threshold'], RETURN_PERIODS, 365)
+        out.append({'case': 'ef.fit_return_levels_sdfc (GPD)', 'size': daily.size, 'time': t, 'peak_mb': mem,
+                    'max_rel_error': max_rel_error(res, reference)})
+    return out
+
+
+def bench_bootstrap(n_years=100, n_boot=1000):
+    data = synthetic_gev(n_years)
+    reference = reference_gev_levels(data, RETURN_PERIODS)
+    out = []
+
+    # the central estimate must lie inside the bootstrapped range
+    res, t, mem = measure(gf.fit_return_levels, data, RETURN_PERIODS, N_boot=n_boot)
+    lower, upper = res['range'].values.T
+    out.append({'case': 'gf.fit_return_levels (bootstrap)', 'size': n_years, 'n_boot': n_boot,
+                'time': t, 'peak_mb': mem,
+                'reference_in_range': bool(np.all((reference >= lower) & (reference <= upper)))})
+
+    if ef is not None:
+        res, t, mem = measure(ef.fit_return_levels_sdfc, data, RETURN_PERIODS, 1, 'GEV', N_boot=n_boot)
+        lower, upper = res.quantile([0.025, 0.975], 'N').values
+        out.append({'case': 'ef.fit_return_levels_sdfc (GEV, bootstrap)', 'size': n_years, 'n_boot': n_boot,
+                    'time': t, 'peak_mb': mem,
+                    'reference_in_range': bool(np.all((reference >= lower) & (reference <= upper)))})
+    return out
+
+
+def bench_grid(nlat, nlon, ntime=50, n_check=10):
+    out = []
+    if ef is None:
+        return out
+    da = synthetic_grid(nlat, nlon, ntime)
+    res, t, mem = measure(ef.fit_return_levels_sdfc_2d, da, RETURN_PERIODS, 1, 'GEV', None)
+
+    # compare a few grid points against scipy
+    rng = np.random.default_rng(0)
+    errors = []
+    for _ in range(min(n_check, nlat * nlon)):
+        ilat, ilon = rng.integers(nlat), rng.integers(nlon)
+        dai = da.isel(latitude=ilat, longitude=ilon)
+        levels = res.sel(latitude=dai['latitude'], longitude=dai['longitude'])
+        errors.append(max_rel_error(levels, reference_gev_levels(dai.values, RETURN_PERIODS)))
+    out.append({'case': 'ef.fit_return_levels_sdfc_2d (GEV)', 'size': '%ix%i' % (nlat, nlon), 'ntime': ntime,
+                'time': t, 'peak_mb': mem, 'time_per_point': t / (nlat * nlon),
+                'max_rel_error': max(errors)})
+    return out
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    '''
+    Return list of cases whose run time exceeds the baseline by more than the tolerance factor
+    '''
+    previous = {(r['case'], str(r['size'])): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        key = (r['case'], str(r['size']))
+        if key in previous and r['time'] > tolerance * previous[key]['time']:
+            regressions.append('%s [%s]: %.3fs vs %.3fs' % (r['case'], r['size'], r['time'], previous[key]['time']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the W2D4 extremes helpers on synthetic data')
+    parser.add_argument('--n-years', type=int, default=100, help='length of single series (years)')
+    parser.add_argument('--n-boot', type=int, default=1000, help='number of bootstrap replicates')
+    parser.add_argument('--grids', default='10x10,45x90', help='comma separated latxlon grid sizes, e.g. 10x10,180x360')
+    parser.add_argument('--no-memory', action='store_true', help='only measure run time')
+    parser.add_argument('--output', default=None, help='write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON file from a previous run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown factor against the baseline')
+    args = parser.parse_args(argv)
+
+    global MEASURE_MEMORY
+    MEASURE_MEMORY = not args.no_memory
+
+    if ef is None:
+        print('SDFC not available: skipping extremes_functions cases')
+
+    results = bench_single_series(args.n_years)
+    results += bench_bootstrap(args.n_years, args.n_boot)
+    for grid in args.grids.split(','):
+        nlat, nlon = [int(n) for n in grid.lower().split('x')]
+        results += bench_grid(nlat, nlon)
+
+    for r in results:
+        print('%-45s %-10s %9.3f s %9.1f MB' % (r['case'], r['size'], r['time'], r['peak_mb']))
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('Performance regressions:\n' + '\n'.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+'''
+Shared random number handling for the bootstrap code in gev_functions and extremes_functions
+
+Every task (bootstrap replicate, grid point, ...) gets its own child of one np.random.SeedSequence,
+so results do not depend on how many threads or processes share the work, and parallel workers
+never draw from correlated streams.
+'''
+import contextlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+
+def seed_sequence(seed=None):
+    '''
+    Turn seed (None, int, SeedSequence or Generator) into a SeedSequence
+    With seed=None the entropy is drawn from the global numpy state, so np.random.seed()
+    at the top of a notebook still makes the results reproducible.
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(2**63))
+    if seed is None:
+        seed = np.random.randint(2**32, dtype=np.uint64)
+    return np.random.SeedSequence(seed)
+
+
+def spawn_seeds(seed, n):
+    '''
+    n independent child SeedSequences, one per task
+    '''
+    return seed_sequence(seed).spawn(n)
+
+
+@contextlib.contextmanager
+def legacy_seed(seed=None):
+    '''
+    Seed the global numpy state for code that draws from np.random directly (e.g. SDFC fit_bootstrap)
+    and restore the previous state afterwards. Does nothing for seed=None.
+    The global state is shared between threads: use processes when running this in parallel.
+    '''
+    if seed is None:
+        yield
+        return
+    state = np.random.get_state()
+    np.random.seed(seed_sequence(seed).generate_state(1)[0])
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def map_seeded(func, tasks, seed=None, n_jobs=1, backend='process'):
+    '''
+    Return [func(task, seed_i) for task in tasks] with one child SeedSequence seed_i per task
+    - n_jobs: number of workers, results are identical for any n_jobs
+    - backend: 'process' or 'thread'; for 'process' func and tasks must be picklable
+    '''
+    tasks = list(tasks)
+    seeds = spawn_seeds(seed, len(tasks))
+    if n_jobs == 1 or len(tasks) < 2:
+        return [func(task, s) for task, s in zip(tasks, seeds)]
+
+    if backend == 'process':
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    elif backend == 'thread':
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+    else:
+        raise ValueError('backend %s is not defined' % backend)
+    chunksize = max(1, len(tasks) // (4 * n_jobs))
+    with executor:
+        return list(executor.map(func, tasks, seeds, chunksize=chunksize))
+
+
+def _resample_and_apply(func, data, task, seed):
+    rng = np.random.default_rng(seed)
+    return func(rng.choice(data, size=data.size, replace=True))
+
+
+def bootstrap(func, data, n_boot, seed=None, n_jobs=1, backend='process'):
+    '''
+    Apply func to n_boot resamples (with replacement) of the 1D array data
+    Returns the list of n_boot results, reproducible for a given seed regardless of n_jobs
+    '''
+    data = np.asarray(data)
+    return map_seeded(partial(_resample_and_apply, func, data), range(n_boot), seed=seed, n_jobs=n_jobs, backend=backend)
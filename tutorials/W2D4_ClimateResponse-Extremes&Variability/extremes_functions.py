@@ -1,8 +1,12 @@
 import numpy as np
+import pandas as pd
 import SDFC as sd
 import xarray as xr
 import matplotlib.pyplot as plt
 import texttable as tt
+from functools import partial
+
+from bootstrap_functions import legacy_seed, map_seeded
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -36,6 +40,28 @@ def return_period_obs(da,periods_per_year,threshold=None):
     out['return period'].attrs['units'] = 'year'
     return out
 
+def _n_coefs(law):
+    '''
+    Number of coefficients of each parameter: 1 (stationary) + number of covariates
+    '''
+    return [1 if c is None else 1 + (np.shape(c)[1] if np.ndim(c) > 1 else 1) for c in law._rhs.c_global]
+
+def _coef_index(law):
+    '''
+    Position of each parameter's coefficients in law.coef_
+    Stationary parameters get an int, parameters with covariates a list (intercept, slopes), fixed parameters
+    None (SDFC leaves them out of coef_)
+    '''
+    idx = []
+    start = 0
+    for p, n in zip(law._lhs.names, _n_coefs(law)):
+        if law._lhs.is_fixed(p):
+            idx.append(None)
+            continue
+        idx.append(start if n == 1 else list(range(start, start + n)))
+        start += n
+    return idx
+
 def print_law( law ):
     '''
     Print fitted SDFC model
@@ -51,48 +77,108 @@ def print_law( law ):
     ## Loop on params
 
     covariates = [c is not None for c in law._rhs.c_global]
-    if covariates == [0,0,0]:
-        idx = [0,1,2]
-    elif covariates == [1,0,0]:
-        idx = [[0,1],2,3]
-    elif covariates == [0,1,0]:
-        idx = [0,[1,2],3]
-    elif covariates == [0,0,1]:
-        idx = [0,1,[2,3]]
-    elif covariates == [1,1,0]:
-        idx = [[0,1],[2,3],4]
-    elif covariates == [1,0,1]:
-        idx = [[0,1],2,[3,4]]
-    elif covariates == [0,1,1]:
-        idx = [0,[1,2],[3,4]]
-    elif covariates == [1,1,1]:
-        idx = [[0,1],[2,3],[4,5]]
+    idx = _coef_index(law)
 
     for p in law._lhs.names:
         i = law._lhs.names.index(p)
-        if covariates[i]:
-            label = 'Covariate'
+        label = 'Covariate' if covariates[i] else 'Stationary'
+        if idx[i] is None:
+            coef = 'fixed'
+        elif covariates[i]:
             coef = law.coef_.round(3)[idx[i]].tolist()
         else:
-            label = 'Stationary'
             coef = law.coef_.round(3)[idx[i]]
         
         row = [ p , label , coef ]
         if hasattr(law.info_,'coefs_ci_bs_'):
-            if not law._lhs.is_fixed(p):
+            if idx[i] is not None:
                 row += [ law.info_.coefs_ci_bs_[j,idx[i]].squeeze().round(3).tolist() for j in range(2) ]
             else:
                 row += [ str(None) , str(None) ]
         tab.add_row( row )
     print(tab.draw() + "\n")
 
-def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False,model=False,method='mle',**kwargs):
+def law_summary(laws, labels=None, text=False):
+    '''
+    Summarize fitted SDFC models as one table, one row per coefficient
+    - laws: single law, list of laws or dict {label: law}
+    - labels: optional labels for the laws (default: keys of dict or position in list)
+    - text: if True, return the table rendered as a string instead of the DataFrame
+    Columns: law, kind, method, param, type, term (0: intercept, >0: covariate slope),
+    coef, fixed, ci_lower, ci_upper (NaN without bootstrap). Fixed parameters are not in law.coef_, their
+    coef and ci are NaN.
+    Use .to_xarray() on the result to get a Dataset indexed by (law, param, term).
+    '''
+    if isinstance(laws, dict):
+        labels = list(laws.keys()) if labels is None else labels
+        laws = list(laws.values())
+    elif not isinstance(laws, (list, tuple)):
+        laws = [laws]
+    if labels is None:
+        labels = list(range(len(laws)))
+
+    # group laws with the same structure, each group is then handled with array operations
+    groups = {}
+    for pos, law in enumerate(laws):
+        names = tuple(law._lhs.names)
+        has_ci = hasattr(law.info_, 'coefs_ci_bs_')
+        key = (type(law).__name__, law.method, names, tuple(_n_coefs(law)),
+               tuple(law._lhs.is_fixed(p) for p in names), has_ci)
+        group = groups.setdefault(key, ([], [], []))
+        group[0].append(pos)
+        group[1].append(np.ravel(law.coef_))
+        group[2].append(np.reshape(law.info_.coefs_ci_bs_, (2, -1)) if has_ci else None)
+
+    def _stack(arrays, free):
+        # (n_laws, ..., n) array with the coefficients of every law on the rows of the free (not fixed)
+        # parameters, NaN on the fixed ones and where a law has fewer coefficients than free parameters
+        n_free = free.sum()
+        if len({a.shape for a in arrays}) == 1 and arrays[0].shape[-1] >= n_free:
+            values = np.array(arrays, dtype=float)[..., :n_free]
+        else:
+            values = np.full((len(arrays),) + arrays[0].shape[:-1] + (n_free,), np.nan)
+            for i, a in enumerate(arrays):
+                values[i, ..., :min(n_free, a.shape[-1])] = a[..., :n_free]
+        out = np.full(values.shape[:-1] + (len(free),), np.nan)
+        out[..., free] = values
+        return out
+
+    cols = {k: [] for k in ['pos', 'kind', 'method', 'param', 'type', 'term', 'coef', 'fixed', 'ci_lower', 'ci_upper']}
+    for (kind, method, names, counts, fixed, has_ci), (pos, coefs, cis) in groups.items():
+        counts = np.array(counts)
+        n = counts.sum()
+        m = len(pos)
+        fixed = np.repeat(fixed, counts)
+        coef = _stack(coefs, ~fixed)
+        ci = _stack(cis, ~fixed) if has_ci else np.full((m, 2, n), np.nan)
+
+        cols['pos'].append(np.repeat(pos, n))
+        cols['kind'].append(np.repeat(kind, m * n))
+        cols['method'].append(np.repeat(method, m * n))
+        cols['param'].append(np.tile(np.repeat(names, counts), m))
+        cols['type'].append(np.tile(np.where(np.repeat(counts > 1, counts), 'Covariate', 'Stationary'), m))
+        cols['term'].append(np.tile(np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts), m))
+        cols['coef'].append(coef.ravel())
+        cols['fixed'].append(np.tile(fixed, m))
+        cols['ci_lower'].append(ci[:, 0].ravel())
+        cols['ci_upper'].append(ci[:, 1].ravel())
+
+    out = pd.DataFrame({k: np.concatenate(v) for k, v in cols.items()} if groups else {k: [] for k in cols})
+    # restore the order in which the laws were given
+    out = out.sort_values('pos', kind='stable').reset_index(drop=True)
+    out.insert(0, 'law', [labels[i] for i in out.pop('pos')])
+    if text:
+        return out.to_string(index=False, float_format=lambda x: '%.3f' % x)
+    return out
+
+def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False,model=False,method='mle',seed=None,**kwargs):
     '''
     Fit data to GPD or GEV and return results
     Inputs:
         - da: 1D DataArray of numpy array, timeseries
         - threshold: threshold for GPD
         - times: return times in years for which to compute return levels, 1D Array
+        - seed: seed for the SDFC bootstrap (see bootstrap_functions.legacy_seed), None keeps the global numpy state
 
     2013/10/13: drop NaNs from array before computing
     '''
@@ -120,10 +206,11 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
     if kind.upper() == 'GPD':
         threshold = kwargs['f_loc']
         law_gpd = sd.GPD(method = method.lower())
-        if N_boot:
-            law_gpd.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
-        else:
-            law_gpd.fit_bootstrap(Y,**kwargs)
+        with legacy_seed(seed):
+            if N_boot:
+                law_gpd.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
+            else:
+                law_gpd.fit_bootstrap(Y,**kwargs)
         # law_gpd.fit(Y, **kwargs)
         # law_gpd.fit(Y, f_loc = threshold,**kwargs)
         zeta_u = Y[Y>threshold].size / Y.size # fraction of points exceeding threshold
@@ -178,10 +265,11 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
             return out
     elif kind.upper() == 'GEV':
         law_gev = sd.GEV(method = method.lower())
-        if N_boot:
-            law_gev.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
-        else:
-            law_gev.fit(Y,**kwargs)
+        with legacy_seed(seed):
+            if N_boot:
+                law_gev.fit_bootstrap(Y,n_bootstrap=N_boot,alpha=0.05,**kwargs)
+            else:
+                law_gev.fit(Y,**kwargs)
 
         # zeta_u = Y[Y>threshold].size / Y.size # fraction of points exceeding threshold
         # According to Coles 2001, Eq. 4.13 ff
@@ -243,7 +331,11 @@ def fit_return_levels_sdfc(da,times,periods_per_year,kind,N_boot=None,full=False
     else:
         raise ValueError('kind %s is not defined' % kind)
     
-def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=None,full=False,method='mle',**kwargs):
+def _fit_point(fit_kwargs,task,seed):
+    dai, kwargs2 = task
+    return fit_return_levels_sdfc(dai,seed=seed,**fit_kwargs,**kwargs2)
+
+def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=None,full=False,method='mle',seed=None,n_jobs=1,**kwargs):
     '''
     Iterate over latitude, longitude and fit indendently at each location, same threshold
     - full: also get obs and parameters at each location
@@ -252,6 +344,8 @@ def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=N
         if percentile: fixed percentile for each point
     - method: 
         use SDFC MLE ('MLE') or L-Moments ('LM')
+    - seed: each grid point gets its own random stream derived from seed (see bootstrap_functions)
+    - n_jobs: number of processes, results do not depend on it
     - fixed parameters (f_loc, f_scale, f_shape) set in kwarsgs
         those are either:
             -single float value - then the parameter is set for the entire 2d region
@@ -266,13 +360,8 @@ def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=N
             print('GPD: ERROR: Need to set ONLY ONE of threshold, percentile')
             return 
 
-    func = fit_return_levels_sdfc
-    tmps = []
-    i = 1
+    tasks = []
     for lati in da['latitude'].values:
-        print('Latitude: %i / %i : %.1f' % (i,da['latitude'].size,lati))
-        i += 1
-        tmpsi = []
         for loni in da['longitude'].values:
             dai = da.sel(latitude=lati,longitude=loni)
             kwargs2 = {}
@@ -284,17 +373,20 @@ def fit_return_levels_sdfc_2d(da,times,periods_per_year,kind,N_boot,percentile=N
 
             if kind.upper() == 'GPD' and percentile is not None:
                 kwargs2['f_loc'] = np.quantile(dai.values,percentile)
-            # tmp = ex.fit_return_levels(dai,threshold=threshold,times=times,periods_per_year=periods_per_year,N_boot=N_boot,full=full)
-            tmp = func(dai,times=times,periods_per_year=periods_per_year,kind=kind,N_boot=N_boot,full=full,method=method,**kwargs2)
-            # tmp['longitude'] = loni
-            # # tmp['latitude'] = lati
-            # tmpsi.append(tmp)
-            # print(loni)
-            # # return tmp
+            tasks.append((dai,kwargs2))
+
+    print('Fitting %i grid points (%i latitudes x %i longitudes)' % (len(tasks),da['latitude'].size,da['longitude'].size))
+    fit_kwargs = dict(times=times,periods_per_year=periods_per_year,kind=kind,N_boot=N_boot,full=full,method=method)
+    results = map_seeded(partial(_fit_point,fit_kwargs),tasks,seed=seed,n_jobs=n_jobs)
+
+    tmps = []
+    nlon = da['longitude'].size
+    for i, lati in enumerate(da['latitude'].values):
+        tmpsi = []
+        for j, loni in enumerate(da['longitude'].values):
+            tmp = results[i * nlon + j]
             try:
-                # tmp['N']
                 tmp['longitude'] = loni
-                # tmp['latitude'] = lati
                 tmpsi.append(tmp)
             except:
                 print('Error, no N')
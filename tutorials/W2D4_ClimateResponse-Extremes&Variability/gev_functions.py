@@ -5,6 +5,8 @@ import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 
+from bootstrap_functions import bootstrap
+
 def estimate_return_level(quantile,loc,scale,shape):
     level = loc + scale / shape * (1 - (-np.log(quantile))**(shape))
     return level
@@ -38,9 +40,14 @@ def empirical_return_level(data):
         data=df['sorted'],name='level')
     return out
 
-def fit_return_levels(data,years,N_boot=None,alpha=0.05):
+def _fit_gev(data):
+    return gev.fit(data,0)
+
+def fit_return_levels(data,years,N_boot=None,alpha=0.05,seed=None,n_jobs=1):
     '''
     Fit GEV to data, compute return levels and confidence intervals
+    - seed: seed for the bootstrap resampling (see bootstrap_functions.seed_sequence)
+    - n_jobs: number of processes for the bootstrap fits, results do not depend on it
     '''
     empirical = empirical_return_level(data).rename({'period':'period_emp'}).rename('empirical')
     shape, loc, scale = gev.fit(data,0)
@@ -60,21 +67,10 @@ def fit_return_levels(data,years,N_boot=None,alpha=0.05):
     )
 
     if N_boot:
-        levels = []
-        shapes, locs, scales = [],[],[]
-        for i in range(N_boot):
-            datai = np.random.choice(data,size=data.size,replace=True)
-            # print(datai.mean())
-            shapei,loci,scalei = gev.fit(datai,0)
-            shapes.append(shapei)
-            locs.append(loci)
-            scales.append(scalei)
-            leveli = estimate_return_level_period(years,loci,scalei,shapei)
-            levels.append(
-                leveli
-            )
+        params = np.array(bootstrap(_fit_gev,np.asarray(data),N_boot,seed=seed,n_jobs=n_jobs))
+        shapes, locs, scales = params.T
+        levels = estimate_return_level_period(np.asarray(years)[None,:],locs[:,None],scales[:,None],shapes[:,None])
 
-        levels = np.array(levels)
         quant = alpha / 2, 1-alpha/2
         quantiles = np.quantile(levels,quant,axis=0)
 
@@ -2,10 +2,13 @@
 # initalize list to store parameters from samples
 params = []
 
+# random number generator with a fixed seed, so the resampling is reproducible
+rng = np.random.default_rng(42)
+
 # generate 1000 samples by resampling data with replacement
 for i in range(1000):
     params.append(
-        gev.fit(np.random.choice(precipitation, size=precipitation.size, replace=True))
+        gev.fit(rng.choice(precipitation, size=precipitation.size, replace=True))
     )
 
 # print the estimate of the mean of each parameter and it's confidence intervals
@@ -0,0 +1,222 @@
+'''
+Cached area weights and fast global / regional means
+
+global_mean in the W2D1 tutorials (ds.weighted(ds.areacello.fillna(0)).mean(["x", "y"])) recomputes and
+renormalizes the weights and scans the NaN mask for every dataset of the tree, and every region (Nino 3.4 in
+W1D2, ...) is another full pass over the data. Here the weights of all regions of a grid are computed once as
+one sparse matrix (regions x grid cells, each row normalized over the valid cells of its region) and cached on
+disk, keyed by a hash of the grid. A regional mean is then a single sparse matrix product over the flattened
+spatial axes, batched over every other dimension (time, member, ...) at once:
+
+    import area_weights
+    weights = area_weights.region_weights(ds.areacello, ['global', 'nino34', 'nino3', 'nino4'])
+    means = area_weights.regional_mean(ds, weights)                # dims (..., region)
+    dt_gm = dt_with_area.map_over_subtree(area_weights.global_mean)  # same as global_mean in W2D1
+
+Regions are names from REGIONS, boxes {'lat': (south, north), 'lon': (west, east)} (degrees east, boxes may
+cross the dateline) or boolean masks on the grid (ocean basins, ...).
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+REGIONS = {
+    'global': None,
+    'nino34': {'lat': (-5, 5), 'lon': (190, 240)},
+    'nino3': {'lat': (-5, 5), 'lon': (210, 270)},
+    'nino4': {'lat': (-5, 5), 'lon': (160, 210)},
+    'nino12': {'lat': (-10, 0), 'lon': (270, 280)},
+    'tropics': {'lat': (-23.5, 23.5), 'lon': (0, 360)},
+    'nh': {'lat': (0, 90), 'lon': (0, 360)},
+    'sh': {'lat': (-90, 0), 'lon': (0, 360)},
+}
+
+_memory = {}
+
+
+def cache_dir():
+    '''
+    Directory of the cached weights: $CMA_WEIGHTS_DIR, else ~/.cache/climatematch/weights
+    '''
+    return os.environ.get('CMA_WEIGHTS_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climatematch', 'weights'))
+
+
+def _box_mask(box, lat, lon):
+    south, north = box['lat']
+    west, east = (value % 360 if value != 360 else 360 for value in box['lon'])
+    lon = lon % 360
+    in_lon = (lon >= west) & (lon <= east) if west <= east else (lon >= west) | (lon <= east)
+    return (lat >= south) & (lat <= north) & in_lon
+
+
+def _region_mask(region, lat, lon):
+    if isinstance(region, str):
+        region = REGIONS[region]
+    if region is None:
+        return np.ones(lat.shape, dtype=bool)
+    if isinstance(region, dict):
+        return _box_mask(region, lat, lon)
+    return np.asarray(region, dtype=bool)
+
+
+def _lat_lon(area, lat, lon):
+    # latitude and longitude of every cell, broadcast to the shape of area
+    lat, lon = area[lat], area[lon]
+    lat, lon = xr.broadcast(lat, lon)
+    return (lat.transpose(*area.dims).values, lon.transpose(*area.dims).values)
+
+
+def _hash(*arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype, array.shape)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class RegionWeights:
+    '''
+    Normalized area weights of several regions of one grid: matrix is a scipy.sparse CSR matrix of shape
+    (regions, cells) over the grid flattened in the order of dims
+    '''
+    def __init__(self, matrix, names, dims, shape):
+        self.matrix = matrix
+        self.names = list(names)
+        self.dims = tuple(dims)
+        self.shape = tuple(shape)
+        self._columns = None
+
+    def columns(self):
+        '''
+        Indices of the cells with a weight in any region and the dense (cells, regions) weights of those cells
+        '''
+        if self._columns is None:
+            cells = np.unique(self.matrix.indices)
+            self._columns = cells, self.matrix[:, cells].T.toarray()
+        return self._columns
+
+    def save(self, fname):
+        m = self.matrix
+        np.savez(fname, data=m.data, indices=m.indices, indptr=m.indptr,
+                 header=json.dumps({'names': self.names, 'dims': self.dims, 'shape': self.shape}))
+
+    @classmethod
+    def load(cls, fname):
+        import scipy.sparse
+
+        with np.load(fname) as f:
+            header = json.loads(str(f['header']))
+            matrix = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                             shape=(len(header['names']), int(np.prod(header['shape']))))
+        return cls(matrix, header['names'], header['dims'], header['shape'])
+
+
+def region_weights(area, regions=('global',), mask=None, lat='lat', lon='lon', names=None, use_cache=True):
+    '''
+    Weights of regions (names in REGIONS, boxes or boolean masks, see the module docstring) on the grid of the
+    cell area DataArray area, whose lat / lon coordinates locate the cells. Cells where area is NaN, or where
+    mask (e.g. ds.tos.isel(time=0).notnull()) is False, get no weight. The weights are cached in memory and in
+    cache_dir(), so every later call for the same grid and regions only hashes the grid.
+    '''
+    import scipy.sparse
+
+    if isinstance(regions, (str, dict)) or regions is None:
+        regions = [regions]
+    names = list(names or [r if isinstance(r, str) else 'region%i' % i for i, r in enumerate(regions)])
+    values = area.values
+    lats, lons = _lat_lon(area, lat, lon)
+    valid = np.isfinite(values) & (values > 0)
+    if mask is not None:
+        valid &= np.asarray(mask.transpose(*area.dims) if isinstance(mask, xr.DataArray) else mask, dtype=bool)
+    masks = [_region_mask(region, lats, lons) for region in regions]
+
+    key = _hash(values, lats, lons, valid, *masks) + '_' + _hash(np.array(names + list(area.dims)))
+    if key in _memory:
+        return _memory[key]
+    fname = os.path.join(cache_dir(), key + '.npz')
+    if use_cache and os.path.exists(fname):
+        weights = RegionWeights.load(fname)
+    else:
+        rows = []
+        for name, region_mask in zip(names, masks):
+            w = np.where(valid & region_mask, values, 0).ravel()
+            total = w.sum()
+            if total == 0:
+                raise ValueError('region %s contains no valid grid cell' % name)
+            rows.append(scipy.sparse.csr_matrix(w / total))
+        weights = RegionWeights(scipy.sparse.vstack(rows, format='csr'), names, area.dims, area.shape)
+        if use_cache:
+            os.makedirs(cache_dir(), exist_ok=True)
+            weights.save(fname + '.part.npz')
+            os.replace(fname + '.part.npz', fname)
+    _memory[key] = weights
+    return weights
+
+
+def _weighted_means(block, weights, skipna):
+    # block (..., cells) -> (..., regions): only the cells with weight are gathered, then one dense product
+    # (BLAS) for all leading dims at once
+    cells, dense = weights.columns()
+    data = block.reshape(-1, block.shape[-1])[:, cells]
+    dense = dense.astype(np.result_type(data.dtype, np.float32), copy=False)
+    missing = np.isnan(data)
+    if not missing.any():
+        means = data @ dense
+    else:
+        data[missing] = 0
+        means = data @ dense
+        if skipna:
+            # renormalize by the share of the region's weight that is valid at each step
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means /= (~missing).astype(dense.dtype) @ dense
+    return means.reshape(block.shape[:-1] + (dense.shape[1],))
+
+
+def regional_mean(obj, weights, skipna=True, keep_attrs=True):
+    '''
+    Area-weighted mean of every variable of obj (Dataset or DataArray) that has the grid dimensions, per
+    region; the result has a 'region' dimension instead of the grid dimensions (variables with only some of
+    them are dropped)
+    With skipna, NaNs that are not already excluded by the weights (e.g. sea ice) are skipped and the weights
+    renormalized per time step, as xarray's weighted mean does. skipna=False treats them as 0, which is faster
+    when the mask of the weights already covers all missing values.
+    '''
+    n_cells = int(np.prod(weights.shape))
+
+    def func(block):
+        # apply_ufunc moves the core dims last, flatten them in the order of the weights
+        block = block.reshape(block.shape[:block.ndim - len(weights.dims)] + (n_cells,))
+        return _weighted_means(block, weights, skipna)
+
+    def mean(da):
+        result = xr.apply_ufunc(func, da, input_core_dims=[list(weights.dims)], output_core_dims=[['region']],
+                                dask='parallelized', output_dtypes=[np.result_type(da.dtype, np.float32)],
+                                dask_gufunc_kwargs={'output_sizes': {'region': len(weights.names)}},
+                                keep_attrs=keep_attrs)
+        return result.assign_coords(region=weights.names)
+
+    if isinstance(obj, xr.DataArray):
+        return mean(obj)
+    grid = set(weights.dims)
+    out = obj.drop_dims([d for d in weights.dims if d in obj.dims])
+    for name, da in obj.data_vars.items():
+        if grid <= set(da.dims):
+            out[name] = mean(da)
+    # same variable order as obj; variables on only part of the grid (e.g. on x only) have no regional mean
+    # and are dropped with the grid dimensions
+    return out[[name for name in obj.data_vars if name in out.data_vars]]
+
+
+def global_mean(ds, area='areacello', dims=('x', 'y'), lat='lat', lon='lon'):
+    '''
+    Global average weighted by the cell area, same result as global_mean in W2D1
+    (ds.weighted(ds.areacello.fillna(0)).mean(["x", "y"])) with the weights of the grid cached
+    '''
+    # weights in the dimension order of the data, so the grid flattens without a copy
+    order = [d for d in ds[list(ds.data_vars)[0]].dims if d in dims] if ds.data_vars else list(dims)
+    weights = region_weights(ds[area].transpose(*order), 'global', lat=lat, lon=lon)
+    return regional_mean(ds, weights).squeeze('region', drop=True)
@@ -0,0 +1,204 @@
+'''
+Streaming climatologies, anomalies and centered rolling means for long gridded records
+
+The tutorials compute climatologies with groupby('time.month').mean(), anomalies with
+groupby('time.month') - clim and smooth them with rolling(time=n, center=True).mean(). This module computes
+the same results (NaN-aware, same window alignment as xarray):
+    - climatology: one pass over the time chunks keeping running sums and counts per month (or day of year)
+    - anomaly: subtracts the climatology by reshaping the time axis to (years, 12) and broadcasting when the
+      record is made of whole consecutive years of monthly data, blockwise indexing otherwise; no groupby
+    - rolling_mean: centered moving averages from cumulative sums, O(1) per step for any window
+    - write_anomalies: streams a record slice by slice into a zarr store, so the full-resolution anomalies
+      never need to fit in memory
+
+All functions accept numpy- or dask-backed xarray DataArrays.
+'''
+import numpy as np
+import xarray as xr
+
+GROUPS = {'month': 12, 'dayofyear': 366}
+
+
+def group_index(time, freq='month'):
+    '''
+    0-based month (0-11) or day of year (0-365) of every time step
+    '''
+    return (getattr(xr.DataArray(time).dt, freq).values - 1).astype(np.intp)
+
+
+class RunningClimatology:
+    '''
+    Running sums and counts per group for data that arrive in time slices, e.g.
+        clim = RunningClimatology(shape=(nlat, nlon))
+        for block, time in slices:
+            clim.update(block, time)
+        mean = clim.mean()
+    '''
+    def __init__(self, shape, freq='month'):
+        self.freq = freq
+        self.sums = np.zeros((GROUPS[freq],) + tuple(shape))
+        self.counts = np.zeros((GROUPS[freq],) + tuple(shape), dtype=np.int64)
+
+    def update(self, block, time):
+        sums, counts = _group_sums(np.asarray(block), group_index(time, self.freq), GROUPS[self.freq])
+        self.sums += sums
+        self.counts += counts
+        return self
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / np.maximum(self.counts, 1), np.nan)
+
+
+def _group_sums(block, index, n_groups):
+    # sums and counts of the valid values of block (time first) per group: the time steps are sorted by
+    # group and every run of equal groups is summed with a single np.add.reduceat
+    sums = np.zeros((n_groups,) + block.shape[1:])
+    counts = np.zeros((n_groups,) + block.shape[1:], dtype=np.int64)
+    if not len(index):
+        return sums, counts
+    order = np.argsort(index, kind='stable')
+    groups, starts = np.unique(index[order], return_index=True)
+    block = block[order]
+    valid = ~np.isnan(block)
+    sums[groups] = np.add.reduceat(np.where(valid, block, 0), starts, axis=0, dtype=float)
+    counts[groups] = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+    return sums, counts
+
+
+def _chunk_sums(block, index, n_groups):
+    # per-chunk partial sums stacked with the counts, reduced over the chunks afterwards
+    sums, counts = _group_sums(block, index.reshape(-1), n_groups)
+    return np.stack([sums, counts.astype(float)])
+
+
+def climatology(da, freq='month', dim='time'):
+    '''
+    Mean per month (freq='month') or day of year (freq='dayofyear'), like da.groupby('time.<freq>').mean(dim)
+    For dask arrays every time chunk contributes running sums and counts and only those are combined,
+    so memory use is one chunk plus the (12 or 366) x space result.
+    '''
+    da = da.transpose(dim, ...)
+    n_groups = GROUPS[freq]
+    index = group_index(da[dim].values, freq)
+    data = da.data
+
+    if hasattr(data, 'map_blocks'):
+        import dask.array as dsa
+
+        index = dsa.from_array(index.reshape((-1,) + (1,) * (data.ndim - 1)),
+                               chunks=(data.chunks[0],) + ((1,),) * (data.ndim - 1))
+        n_blocks = len(data.chunks[0])
+        partial = dsa.map_blocks(_chunk_sums, data, index, n_groups, dtype=float, new_axis=0,
+                                 chunks=((2,), (n_groups,) * n_blocks) + data.chunks[1:])
+        totals = partial.reshape((2, n_blocks, n_groups) + data.shape[1:]).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = dsa.where(totals[1] > 0, totals[0] / dsa.maximum(totals[1], 1), np.nan)
+    else:
+        values = RunningClimatology(data.shape[1:], freq).update(data, da[dim].values).mean()
+
+    present = np.unique(group_index(da[dim].values, freq))
+    clim = xr.DataArray(values, dims=(freq,) + da.dims[1:],
+                        coords={freq: np.arange(1, n_groups + 1), **{d: da[d] for d in da.dims[1:] if d in da.coords}},
+                        name=da.name, attrs=da.attrs)
+    # like groupby, only months / days that occur in the record
+    return clim.isel({freq: present})
+
+
+def _whole_years(index, n_groups):
+    # the record consists of consecutive full cycles of all groups
+    return index.size % n_groups == 0 and np.array_equal(index, np.tile(np.arange(n_groups), index.size // n_groups))
+
+
+def _subtract_block(block, index, values, block_info=None):
+    # the groups of the block's time steps and the climatology of its spatial window
+    location = block_info[0]['array-location']
+    window = tuple(slice(*bounds) for bounds in location[1:])
+    return block - values[(index[slice(*location[0])],) + window]
+
+
+def anomaly(da, clim, dim='time'):
+    '''
+    da minus its climatology (as returned by climatology), like da.groupby('time.<freq>') - clim
+    '''
+    freq = clim.dims[0]
+    n_groups = GROUPS[freq]
+    da_t = da.transpose(dim, ...)
+    index = group_index(da_t[dim].values, freq)
+    # climatology on the full 1..n grid so that positions equal group indices
+    full = clim.reindex({freq: np.arange(1, n_groups + 1)}).transpose(freq, *da_t.dims[1:])
+    values = full.data
+    data = da_t.data
+
+    if hasattr(data, 'map_blocks'):
+        values = np.asarray(values)
+        result = data.map_blocks(_subtract_block, index=index, values=values,
+                                 dtype=np.result_type(data.dtype, values.dtype))
+    elif _whole_years(index, n_groups):
+        # (years, 12, ...) - (12, ...): broadcasting, no per-time-step copy of the climatology
+        result = (data.reshape((-1, n_groups) + data.shape[1:]) - np.asarray(values)).reshape(data.shape)
+    else:
+        result = data - np.asarray(values)[index]
+
+    out = da_t.copy(data=result)
+    out.attrs = da.attrs
+    return out.transpose(*da.dims)
+
+
+def _rolling_mean(data, window, min_periods, axis):
+    # centered moving average along axis from cumulative sums of values and valid counts, with
+    # the window alignment of xarray: label i covers [i - window // 2, i - window // 2 + window)
+    data = np.moveaxis(data, axis, 0)
+    n = data.shape[0]
+    valid = ~np.isnan(data)
+    zero = np.zeros((1,) + data.shape[1:])
+    csum = np.concatenate([zero, np.cumsum(np.where(valid, data, 0), axis=0, dtype=float)])
+    ccount = np.concatenate([zero, np.cumsum(valid, axis=0, dtype=float)])
+
+    start = np.clip(np.arange(n) - window // 2, 0, n)
+    stop = np.clip(np.arange(n) - window // 2 + window, 0, n)
+    sums = csum[stop] - csum[start]
+    counts = ccount[stop] - ccount[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(counts >= min_periods, sums / np.maximum(counts, 1), np.nan)
+    return np.moveaxis(mean, 0, axis)
+
+
+def rolling_mean(da, window, dim='time', min_periods=None):
+    '''
+    Same as da.rolling({dim: window}, center=True, min_periods=min_periods).mean(), through cumulative sums
+    '''
+    min_periods = window if min_periods is None else min_periods
+    axis = da.get_axis_num(dim)
+    data = da.data
+    if hasattr(data, 'rechunk'):
+        # the cumulative sum runs along dim, keep that axis in one chunk
+        data = data.rechunk({axis: -1})
+    out = da.copy(data=_rolling_mean(data, window, min_periods, axis).astype(np.result_type(da.dtype, np.float32)))
+    return out
+
+
+def write_anomalies(da, store, clim=None, freq='month', window=None, dim='time', slice_size=120):
+    '''
+    Compute the anomalies of da (optionally smoothed with a centered rolling mean of window steps) and append
+    them to the zarr store slice_size time steps at a time. Computes the climatology first if not given.
+    Rolling windows that cross slice boundaries use a halo of neighbouring steps, so the result is the same
+    as for the whole record. Returns the climatology.
+    '''
+    if clim is None:
+        clim = climatology(da, freq, dim)
+    # load the climatology once, otherwise every slice would recompute it from the whole record
+    clim = clim.compute()
+    halo = window // 2 + 1 if window else 0
+    n = da.sizes[dim]
+    for i, start in enumerate(range(0, n, slice_size)):
+        stop = min(n, start + slice_size)
+        lo, hi = max(0, start - halo), min(n, stop + halo)
+        piece = anomaly(da.isel({dim: slice(lo, hi)}), clim, dim)
+        if window:
+            piece = rolling_mean(piece, window, dim)
+        piece = piece.isel({dim: slice(start - lo, start - lo + stop - start)}).compute()
+        name = da.name or 'anomaly'
+        piece.to_dataset(name=name).to_zarr(store, mode='w' if i == 0 else 'a',
+                                            append_dim=None if i == 0 else dim)
+    return clim
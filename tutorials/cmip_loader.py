@@ -0,0 +1,227 @@
+'''
+One loader for the CMIP6 ensembles of the W1D5 and W2D1 tutorials
+
+Each of those notebooks opens the Pangeo catalog with intake, searches it, sets aggregation_control, converts
+the result with xMIP preprocessing, searches again for areacello, and joins both into a DataTree. open_cmip6
+does all of this in one call:
+
+    import cmip_loader
+    dt = cmip_loader.open_cmip6(['TaiESM1', 'MPI-ESM1-2-LR'], ['historical', 'ssp126', 'ssp585'], 'tos',
+                                members=['r1i1p1f1'], table_id='Omon', time=('1950', '2100'),
+                                region={'lat': (-30, 30), 'lon': (120, 290)})
+    dt['TaiESM1']['ssp585'].ds.tos
+
+    - the catalog is read once as a table and filtered with pandas
+    - the stores are opened concurrently, xMIP's combined_preprocessing is applied lazily
+    - the time range and the region are selected before anything is loaded
+    - areacello (or other grid metrics) is opened once per model and attached to every experiment
+    - each (model, experiment) subset is written once to a local consolidated zarr store, later calls (from
+      any notebook) open that store instead of the cloud data
+
+catalog may be the Pangeo ESM collection (default), a CSV file in the same format, or a local directory
+holding zarr stores in the layout of the Pangeo bucket (<activity>/<institution>/<source>/<experiment>/<member>/
+<table>/<variable>/<grid>[/<version>]), e.g. a mirror made with gsutil for offline use.
+'''
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+PANGEO_CATALOG = 'https://storage.googleapis.com/cmip6/pangeo-cmip6.json'
+FACETS = ['activity_id', 'institution_id', 'source_id', 'experiment_id', 'member_id', 'table_id', 'variable_id',
+          'grid_label']
+METRIC_TABLES = {'areacello': 'Ofx', 'areacella': 'fx', 'volcello': 'Ofx', 'sftlf': 'fx'}
+
+_catalogs = {}
+
+
+def cache_dir():
+    '''
+    Directory of the cached subsets: $CMA_CMIP6_DIR, else ~/.cache/climatematch/cmip6
+    '''
+    return os.environ.get('CMA_CMIP6_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climatematch', 'cmip6'))
+
+
+def _directory_catalog(root):
+    # one row per zarr store below root, facets parsed from the path
+    rows = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '.zgroup' in filenames or 'zarr.json' in filenames:
+            dirnames[:] = []
+            parts = os.path.relpath(dirpath, root).split(os.sep)
+            if parts[-1].startswith('v') and parts[-1][1:].isdigit():
+                parts = parts[:-1]
+            if len(parts) >= len(FACETS):
+                rows.append(dict(zip(FACETS, parts[-len(FACETS):]), zstore=dirpath))
+    return pd.DataFrame(rows, columns=FACETS + ['zstore'])
+
+
+def read_catalog(catalog=None):
+    '''
+    Catalog table (one row per store, columns FACETS + zstore): from an ESM collection JSON, a CSV or a local
+    directory of zarr stores; read once per session
+    '''
+    catalog = catalog or os.environ.get('CMA_CMIP6_CATALOG', PANGEO_CATALOG)
+    if catalog not in _catalogs:
+        if os.path.isdir(catalog):
+            df = _directory_catalog(catalog)
+        else:
+            if catalog.endswith('.json'):
+                import fsspec
+
+                with fsspec.open(catalog, 'r') as f:
+                    esmcol = json.load(f)
+                csv = esmcol.get('catalog_file')
+                if not csv.startswith(('http', 'gs://', 's3://', '/')):
+                    csv = catalog.rsplit('/', 1)[0] + '/' + csv
+            else:
+                csv = catalog
+            df = pd.read_csv(csv, dtype=str)
+        _catalogs[catalog] = df
+    return _catalogs[catalog]
+
+
+def search(df, **facets):
+    '''
+    Rows of the catalog table matching facets (a value or a list of values per column, as intake's search)
+    '''
+    keep = np.ones(len(df), dtype=bool)
+    for facet, values in facets.items():
+        if values is None:
+            continue
+        values = [values] if isinstance(values, str) else list(values)
+        keep &= df[facet].isin(values).values
+    return df[keep]
+
+
+def _cftime():
+    # use_cftime=True as in the tutorials, through the time coder on recent xarray versions
+    if hasattr(xr, 'coders') and hasattr(xr.coders, 'CFDatetimeCoder'):
+        return {'decode_times': xr.coders.CFDatetimeCoder(use_cftime=True)}
+    return {'use_cftime': True}
+
+
+def _open_store(zstore, preprocess, storage_options):
+    ds = xr.open_zarr(zstore, consolidated=True, storage_options=storage_options, **_cftime())
+    if preprocess:
+        from xmip.preprocessing import combined_preprocessing
+
+        ds = combined_preprocessing(ds)
+    return ds
+
+
+def _region_slices(ds, region):
+    # index ranges of the (possibly curvilinear) grid covering the lat / lon box of region; a box that
+    # crosses the longitude seam of the grid keeps the full longitude range
+    lat, lon = ds['lat'], ds['lon'] % 360
+    south, north = region['lat']
+    west, east = region['lon'][0] % 360, region['lon'][1] % 360 if region['lon'][1] != 360 else 360
+    in_lon = ((lon >= west) & (lon <= east)) if west <= east else ((lon >= west) | (lon <= east))
+    inside = (lat >= south) & (lat <= north) & in_lon
+    slices = {}
+    for dim in inside.dims:
+        hit = np.flatnonzero(inside.any([d for d in inside.dims if d != dim]).values)
+        if hit.size == 0:
+            raise ValueError('region %s is outside of the grid' % (region,))
+        slices[dim] = slice(hit[0], hit[-1] + 1)
+    return slices
+
+
+def _subset(ds, time=None, region=None):
+    if time is not None and 'time' in ds.dims:
+        ds = ds.sel(time=slice(*time))
+    if region is not None:
+        ds = ds.isel(_region_slices(ds, region))
+    return ds
+
+
+def _cache_path(model, experiment, rows, time, region, preprocess, metrics, grid_label):
+    key = hashlib.sha1(json.dumps([sorted(rows.zstore), time, region, preprocess, sorted(metrics), grid_label],
+                                  default=str).encode())
+    return os.path.join(cache_dir(), model, experiment, key.hexdigest()[:16] + '.zarr')
+
+
+def _combine(datasets):
+    # merge the variables of every member, then stack the members along member_id
+    members = {}
+    for (member, _), ds in datasets:
+        members.setdefault(member, []).append(ds)
+    merged = [xr.merge(dss, compat='override', join='outer').expand_dims(member_id=[member])
+              for member, dss in sorted(members.items())]
+    return xr.concat(merged, dim='member_id', coords='minimal', compat='override', join='outer')
+
+
+def open_cmip6(models, experiments, variables, members=None, table_id='Omon', grid_label='gn', time=None,
+               region=None, metrics=('areacello',), catalog=None, preprocess=True, cache=True, n_jobs=16,
+               storage_options={'token': 'anon'}):
+    '''
+    DataTree /<model>/<experiment> of the given variables (members stacked along member_id), restricted to the
+    time range (start, end) and region {'lat': (south, north), 'lon': (west, east)}, with the grid metrics
+    attached as coordinates (as _parse_metric in the tutorials). Only models that have every experiment
+    are returned (require_all_on=['source_id']). With cache, every (model, experiment) is read from the
+    cloud only once and later opened from a local consolidated zarr store.
+    '''
+    try:
+        from xarray import DataTree
+    except ImportError:
+        from datatree import DataTree
+
+    as_list = lambda x: [x] if isinstance(x, str) else list(x)
+    models, experiments, variables = as_list(models), as_list(experiments), as_list(variables)
+    df = read_catalog(catalog)
+    rows = search(df, source_id=models, experiment_id=experiments, variable_id=variables,
+                  member_id=members, table_id=table_id, grid_label=grid_label)
+    complete = rows.groupby('source_id').experiment_id.nunique() == len(experiments)
+    models = [m for m in models if complete.get(m, False)]
+    time = tuple(time) if time is not None else None
+    storage_options = None if catalog is not None and os.path.isdir(catalog) else storage_options
+
+    # one task per store that is not cached yet
+    nodes, todo = {}, {}
+    for model in models:
+        for experiment in experiments:
+            node_rows = rows[(rows.source_id == model) & (rows.experiment_id == experiment)]
+            path = _cache_path(model, experiment, node_rows, time, region, preprocess, metrics, grid_label)
+            nodes[model, experiment] = path
+            if not (cache and os.path.exists(path)):
+                for row in node_rows.itertuples():
+                    todo[row.zstore] = (model, experiment, row.member_id, row.variable_id)
+    # grid metrics are only needed for the models with subsets still to write
+    uncached = sorted({model for model, _, _, _ in todo.values()})
+    metric_rows = search(df, source_id=uncached, variable_id=list(metrics), grid_label=grid_label,
+                         table_id=sorted({METRIC_TABLES.get(metric, 'fx') for metric in metrics}))
+    metric_rows = metric_rows.sort_values(['experiment_id', 'member_id']).drop_duplicates(['source_id', 'variable_id'])
+
+    def open_one(zstore):
+        return _subset(_open_store(zstore, preprocess, storage_options), time, region)
+
+    opened, metric_ds = {}, {}
+    if todo:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            opened = dict(zip(todo, executor.map(open_one, todo)))
+            metric_ds = dict(zip(metric_rows.zstore, executor.map(open_one, metric_rows.zstore)))
+
+    tree = {}
+    for (model, experiment), path in nodes.items():
+        if not (cache and os.path.exists(path)):
+            ds = _combine([((member, var), opened[zstore]) for zstore, (m, e, member, var) in todo.items()
+                           if (m, e) == (model, experiment)])
+            for row in metric_rows[metric_rows.source_id == model].itertuples():
+                metric = metric_ds[row.zstore][row.variable_id].squeeze(drop=True)
+                ds = ds.assign_coords({row.variable_id: metric.drop_vars([c for c in metric.coords
+                                                                          if c not in metric.dims])})
+            if not cache:
+                tree['/%s/%s' % (model, experiment)] = ds
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # the chunks and codecs of the source stores do not apply to the subset: 10 years of monthly data
+            # (full horizontal grid) per chunk
+            ds = ds.drop_encoding().chunk({dim: 120 if dim == 'time' else -1 for dim in ds.dims})
+            ds.to_zarr(path + '.part', mode='w', consolidated=True)
+            os.replace(path + '.part', path)
+        tree['/%s/%s' % (model, experiment)] = xr.open_zarr(path, consolidated=True, **_cftime())
+    return DataTree.from_dict(tree)
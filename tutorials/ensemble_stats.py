@@ -0,0 +1,113 @@
+'''
+Lazy anomalies and multi-model ensemble statistics on DataTrees /<model>/<experiment>
+
+datatree_anomaly in W2D1 recomputes the reference period mean of every model each time it is called and the
+plot_historical_ssp126* helpers concatenate historical and scenario runs model by model. Here:
+    - reference_means computes the reference period mean of each model once (cached for the session)
+    - anomaly_tree subtracts them lazily, nothing is computed until the data are plotted or loaded
+    - combined concatenates historical and scenario runs as a dask view of the original chunks (no copy)
+    - ensemble_stats puts all models on a common monthly calendar, stacks them along a 'model' dimension and
+      computes the ensemble mean, spread and percentiles in a single pass over the data, chunk by chunk,
+      so the memory use does not grow with the number of models
+
+    import ensemble_stats
+    dt_gm_anomaly = ensemble_stats.anomaly_tree(dt_gm)
+    stats = ensemble_stats.ensemble_stats(dt_gm_anomaly, 'tos', ['historical', 'ssp126'])
+    stats['mean'].plot(); ...
+'''
+import cftime
+import xarray as xr
+
+_references = {}
+
+
+def _token(ds):
+    # identifies the data of ds: the names of its dask graph, or a hash of numpy-backed values
+    from dask.base import tokenize
+
+    return tokenize(ds)
+
+
+def reference_means(dt, period=('1950', '1980'), experiment='historical'):
+    '''
+    {model: mean of its experiment over period} as computed (loaded) datasets; the means missing from the
+    session cache are computed together in one pass
+    '''
+    import dask
+
+    keys, todo = {}, {}
+    for model, subtree in dt.children.items():
+        ds = subtree[experiment].to_dataset().sel(time=slice(*period))
+        keys[model] = (_token(ds), tuple(period))
+        if keys[model] not in _references:
+            todo[keys[model]] = ds.mean('time')
+    (computed,) = dask.compute(todo)
+    _references.update(computed)
+    return {model: _references[key] for model, key in keys.items()}
+
+
+def anomaly_tree(dt, period=('1950', '1980'), experiment='historical'):
+    '''
+    Same as datatree_anomaly in W2D1 (every experiment of a model minus the mean of its historical run over
+    period), lazy and with the reference means computed only once
+    '''
+    refs = reference_means(dt, period, experiment)
+    return type(dt).from_dict({'/%s/%s' % (model, exp): node.to_dataset() - refs[model]
+                               for model, subtree in dt.children.items()
+                               for exp, node in subtree.children.items()})
+
+
+def combined(dt, model, variable, experiments=('historical', 'ssp126')):
+    '''
+    The experiments of a model concatenated along time (historical followed by a scenario), as a lazy view of
+    the chunks of the original data
+    '''
+    parts = []
+    for experiment in experiments:
+        da = dt[model][experiment].to_dataset()[variable]
+        # dask-backed parts are concatenated in the graph, without copying data
+        parts.append(da if da.chunks is not None else da.chunk())
+    return xr.concat(parts, dim='time')
+
+
+def common_time(da):
+    '''
+    da on a calendar shared by all models: every monthly time step labelled with the first day of its month
+    in the noleap calendar, whatever the calendar of the model
+    '''
+    times = da.indexes['time']
+    labels = [cftime.DatetimeNoLeap(t.year, t.month, 1) for t in times]
+    return da.assign_coords(time=labels)
+
+
+def ensemble(dt, variable, experiments=('historical', 'ssp126'), models=None):
+    '''
+    The combined experiments of every model (or of models) stacked along a 'model' dimension, on the common
+    calendar and restricted to the time steps shared by all models; lazy
+    '''
+    models = list(models or dt.children)
+    members = [common_time(combined(dt, model, variable, experiments)) for model in models]
+    stacked = xr.concat(members, dim='model', join='inner', coords='minimal', compat='override')
+    return stacked.assign_coords(model=models)
+
+
+def ensemble_stats(dt, variable, experiments=('historical', 'ssp126'), quantiles=(0.05, 0.95), models=None):
+    '''
+    Dataset with the multi-model mean, standard deviation (std), minimum, maximum and quantiles of variable
+    (combined experiments, common calendar), computed together in one pass over the data
+    '''
+    import dask
+
+    stacked = ensemble(dt, variable, experiments, models)
+    # the model axis in one chunk, so that every statistic is a blockwise reduction over the same chunks
+    stacked = stacked.chunk({'model': -1})
+    stats = {
+        'mean': stacked.mean('model'),
+        'std': stacked.std('model'),
+        'min': stacked.min('model'),
+        'max': stacked.max('model'),
+    }
+    for q in quantiles:
+        stats['q%02i' % round(100 * q)] = stacked.quantile(q, 'model').drop_vars('quantile')
+    (stats,) = dask.compute(stats)
+    return xr.Dataset(stats, attrs={'models': [str(m) for m in stacked.model.values], 'experiments': list(experiments)})
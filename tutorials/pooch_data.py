@@ -0,0 +1,370 @@
+'''
+Shared data access for the tutorial and project notebooks
+
+The notebooks each define a `pooch_load(filelocation, filename, processor)` helper that looks for the file in
+a per-day shared directory on the JupyterHub and otherwise downloads it into the temp dir. This module provides:
+    - a manifest (data_manifest.json) of every remote file the notebooks load: URL, file name, the shared
+      location the notebook looks in, and, once fetched, its sha256 and size
+    - a parallel prefetcher that downloads everything once into a persistent store, laid out so the
+      notebooks' own shared_location lookup finds every file (no network access at notebook start)
+    - hash-verified reuse: files with the same content are stored once and linked into every day
+    - a mirror mode (CMA_DATA_MIRROR) in which a local directory, laid out as <host>/<path>, stands in
+      for all remote URLs
+    - pooch_load, a drop-in replacement for the notebook helper that uses all of the above
+
+Usage (from the repository root):
+    python tutorials/pooch_data.py manifest                      # rescan the notebooks
+    python tutorials/pooch_data.py prefetch --jobs 8             # download into CMA_DATA_DIR
+    python tutorials/pooch_data.py prefetch --update-manifest    # also record hashes and sizes
+    python tutorials/pooch_data.py verify                        # check the store against the manifest
+'''
+import os
+import ast
+import sys
+import json
+import glob
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+tutorials_dir = os.path.dirname(os.path.abspath(__file__))
+manifest_file = os.path.join(tutorials_dir, 'data_manifest.json')
+shared_root = '/home/jovyan/shared'  # the notebooks' shared_location paths all start with this
+
+
+def data_dir():
+    '''
+    Root of the persistent store: $CMA_DATA_DIR, the JupyterHub shared directory if it exists, else the user cache
+    '''
+    if 'CMA_DATA_DIR' in os.environ:
+        return os.environ['CMA_DATA_DIR']
+    if os.path.isdir(shared_root):
+        return shared_root
+    return os.path.join(os.path.expanduser('~'), '.cache', 'climatematch')
+
+
+def mirror_dir():
+    return os.environ.get('CMA_DATA_MIRROR')
+
+
+def mirror_path(url, mirror):
+    '''
+    Location of url in a mirror directory: <mirror>/<host>/<path>, <path>/index for URLs ending in /
+    (e.g. https://osf.io/xxxxx/download/)
+    '''
+    parsed = urlparse(url)
+    path = parsed.path.lstrip('/')
+    if path == '' or path.endswith('/'):
+        path += 'index'
+    if parsed.query:
+        path += '?' + parsed.query
+    return os.path.join(mirror, parsed.netloc, *path.split('/'))
+
+
+def file_hash(fname, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# manifest
+
+
+def _strip_magics(source):
+    return '\n'.join('' if line.lstrip().startswith(('%', '!')) else line for line in source.split('\n'))
+
+
+def _resolve(node, names):
+    # value of a string expression built from literals and previously assigned names, None if unknown
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return names.get(node.id)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _resolve(node.left, names), _resolve(node.right, names)
+        return None if left is None or right is None else left + right
+    if isinstance(node, ast.JoinedStr):
+        parts = [_resolve(v.value if isinstance(v, ast.FormattedValue) else v, names) for v in node.values]
+        return None if None in parts else ''.join(parts)
+    return None
+
+
+def _call_args(call):
+    # (filelocation, filename) nodes of a pooch_load call
+    args = dict(zip(['filelocation', 'filename', 'processor'], call.args))
+    args.update({kw.arg: kw.value for kw in call.keywords})
+    return args.get('filelocation'), args.get('filename')
+
+
+def scan_notebook(fname):
+    '''
+    Return the shared_location and the [(url, filename)] of the pooch_load calls of a notebook, and the number
+    of calls whose arguments are not string literals (e.g. built in a loop)
+    '''
+    with open(fname, 'r', encoding='utf-8') as f:
+        notebook = json.load(f)
+    names = {}
+    shared_location = None
+    files = []
+    n_unresolved = 0
+    for cell in notebook['cells']:
+        if cell['cell_type'] != 'code':
+            continue
+        source = cell['source'] if isinstance(cell['source'], str) else ''.join(cell['source'])
+        try:
+            tree = ast.parse(_strip_magics(source))
+        except SyntaxError:
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.FunctionDef) and node.name == 'pooch_load':
+                for stmt in node.body:
+                    if isinstance(stmt, ast.Assign) and getattr(stmt.targets[0], 'id', None) == 'shared_location':
+                        shared_location = _resolve(stmt.value, {})
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                value = _resolve(node.value, names)
+                if value is not None:
+                    names[node.targets[0].id] = value
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'pooch_load':
+                url, filename = [_resolve(n, names) if n is not None else None for n in _call_args(node)]
+                if url is None or filename is None:
+                    n_unresolved += 1
+                elif not url.startswith(('http://', 'https://')):
+                    # placeholders such as url_CO2_CAMS = '' cannot be fetched
+                    continue
+                else:
+                    files.append((url, filename))
+    return shared_location, files, n_unresolved
+
+
+def build_manifest(root, previous=None):
+    '''
+    Scan all notebooks below root; hashes and sizes of entries that are already in previous are kept
+    '''
+    previous = {(e['url'], e['path']): e for e in (previous or {}).get('files', [])}
+    entries = {}
+    n_unresolved = 0
+    fnames = sorted(glob.glob(os.path.join(root, 'tutorials', '**', '*.ipynb'), recursive=True) +
+                    glob.glob(os.path.join(root, 'projects', '**', '*.ipynb'), recursive=True))
+    for fname in fnames:
+        shared_location, files, n = scan_notebook(fname)
+        n_unresolved += n
+        if shared_location is None:
+            continue
+        location = os.path.relpath(shared_location, shared_root)
+        for url, filename in files:
+            path = '/'.join([location.replace(os.sep, '/'), filename])
+            entry = entries.setdefault((url, path), dict(
+                previous.get((url, path), {'url': url, 'path': path, 'sha256': None, 'size': None}), notebooks=[]))
+            notebook = os.path.relpath(fname, root).replace(os.sep, '/')
+            if notebook not in entry['notebooks']:
+                entry['notebooks'].append(notebook)
+    return {'files': sorted(entries.values(), key=lambda e: (e['path'], e['url'])), 'unresolved_calls': n_unresolved}
+
+
+def load_manifest(fname=manifest_file):
+    if not os.path.exists(fname):
+        return {'files': []}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, fname=manifest_file):
+    with open(fname, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.write('\n')
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# store
+
+
+def object_path(root, sha256):
+    return os.path.join(root, '.objects', sha256[:2], sha256)
+
+
+def _link(src, dst):
+    # hard link dst to src (falls back to a copy across file systems)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + '.tmp'
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _download(url, dest):
+    # fetch url into the file dest, from the mirror if one is configured
+    mirror = mirror_dir()
+    if mirror is not None:
+        shutil.copyfile(mirror_path(url, mirror), dest)
+        return
+    import pooch
+    pooch.retrieve(url, known_hash=None, fname=os.path.basename(dest), path=os.path.dirname(dest), progressbar=False)
+
+
+def fetch_entry(entry, root):
+    '''
+    Make sure the manifest entry is in the store under root and return (path in the store, sha256, size)
+    Files whose content is already stored (same sha256, e.g. used on another day) are linked, not downloaded.
+    '''
+    dest = os.path.join(root, *entry['path'].split('/'))
+    sha256 = entry.get('sha256')
+    if sha256 is not None:
+        if os.path.exists(dest) and file_hash(dest) == sha256:
+            return dest, sha256, os.path.getsize(dest)
+        if os.path.exists(object_path(root, sha256)):
+            _link(object_path(root, sha256), dest)
+            return dest, sha256, os.path.getsize(dest)
+    elif os.path.exists(dest):
+        return dest, file_hash(dest), os.path.getsize(dest)
+
+    os.makedirs(os.path.join(root, '.objects'), exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=os.path.join(root, '.objects'))
+    try:
+        tmp = os.path.join(tmpdir, 'download')
+        _download(entry['url'], tmp)
+        actual = file_hash(tmp)
+        if sha256 is not None and actual != sha256:
+            raise ValueError('hash mismatch for %s: expected %s, got %s' % (entry['url'], sha256, actual))
+        obj = object_path(root, actual)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        os.replace(tmp, obj)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    _link(obj, dest)
+    return dest, actual, os.path.getsize(dest)
+
+
+def prefetch(manifest, root=None, n_jobs=8):
+    '''
+    Fetch every manifest entry into the store in parallel; returns the list of (url, error) that failed
+    Hashes and sizes of fetched entries are recorded in the manifest entries.
+    '''
+    root = root or data_dir()
+    failed = []
+    # entries with the same URL are downloaded once and linked into every location
+    by_url = {}
+    for entry in manifest['files']:
+        by_url.setdefault(entry['url'], []).append(entry)
+
+    def fetch_all(entries):
+        _, sha256, size = fetch_entry(entries[0], root)
+        for entry in entries:
+            entry['sha256'], entry['size'] = sha256, size
+        for entry in entries[1:]:
+            fetch_entry(entry, root)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(fetch_all, entries): url for url, entries in by_url.items()}
+        for i, future in enumerate(as_completed(futures)):
+            url = futures[future]
+            status = 'ok'
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((url, repr(e)))
+                status = 'FAILED'
+            print('[%i/%i] %s %s' % (i + 1, len(futures), status, url))
+    return failed
+
+
+def verify(manifest, root=None):
+    '''
+    Return the manifest paths that are missing from the store or whose hash does not match
+    '''
+    root = root or data_dir()
+    bad = []
+    for entry in manifest['files']:
+        dest = os.path.join(root, *entry['path'].split('/'))
+        if not os.path.exists(dest) or (entry.get('sha256') and file_hash(dest) != entry['sha256']):
+            bad.append(entry['path'])
+    return bad
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# notebook helper
+
+
+_manifest_index = None
+
+
+def _lookup(url, filename):
+    global _manifest_index
+    if _manifest_index is None:
+        _manifest_index = {}
+        for entry in load_manifest()['files']:
+            _manifest_index.setdefault((entry['url'], entry['path'].rsplit('/', 1)[-1]), entry)
+            _manifest_index.setdefault((entry['url'], None), entry)
+    return _manifest_index.get((url, os.path.basename(filename))) or _manifest_index.get((url, None))
+
+
+def pooch_load(filelocation=None, filename=None, processor=None):
+    '''
+    Drop-in replacement for the notebook pooch_load helper
+    Looks in the store (see data_dir), then the mirror (CMA_DATA_MIRROR), and only then downloads, verifying the
+    manifest hash when one is known. Downloads of files in the manifest go to the store, so they are reused by
+    every later notebook.
+    '''
+    entry = _lookup(filelocation, filename)
+    root = data_dir()
+    if entry is not None:
+        try:
+            file, _, _ = fetch_entry(entry, root)
+        except OSError:  # read-only shared directory
+            file = None
+        if file is not None:
+            return processor(file, 'fetch', None) if processor is not None else file
+
+    mirror = mirror_dir()
+    if mirror is not None and os.path.exists(mirror_path(filelocation, mirror)):
+        file = mirror_path(filelocation, mirror)
+        return processor(file, 'fetch', None) if processor is not None else file
+
+    import pooch
+    return pooch.retrieve(filelocation, known_hash=entry['sha256'] if entry else None,
+                          fname=os.path.join(tempfile.gettempdir(), filename), processor=processor)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manifest, prefetcher and mirror for the course data')
+    parser.add_argument('command', choices=['manifest', 'prefetch', 'verify'])
+    parser.add_argument('--root', default=None, help='store directory (default: $CMA_DATA_DIR or %s)' % shared_root)
+    parser.add_argument('--jobs', type=int, default=8, help='number of parallel downloads')
+    parser.add_argument('--update-manifest', action='store_true', help='record the hashes and sizes of fetched files')
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest()
+    if args.command == 'manifest':
+        manifest = build_manifest(os.path.dirname(tutorials_dir), manifest)
+        save_manifest(manifest)
+        print('%i files, %i pooch_load calls with computed arguments not listed' % (len(manifest['files']), manifest['unresolved_calls']))
+        return 0
+
+    if args.command == 'prefetch':
+        failed = prefetch(manifest, args.root, args.jobs)
+        if args.update_manifest:
+            save_manifest(manifest)
+        for url, error in failed:
+            print('Download failed:', url, error)
+        return 1 if failed else 0
+
+    bad = verify(manifest, args.root)
+    for path in bad:
+        print('Missing or corrupt:', path)
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
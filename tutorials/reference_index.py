@@ -0,0 +1,216 @@
+'''
+Kerchunk reference index over collections of netCDF files
+
+xr.open_mfdataset parses the HDF5/netCDF metadata of every file on every open, which takes minutes for decades
+of daily files. This module scans the files once, records where every chunk lives (file, offset, length) and
+combines everything into one reference file (JSON, or parquet for large collections). Opening the reference
+gives the whole collection as one lazy, chunked dataset in milliseconds; the chunks are then read in parallel
+straight from the original files, local or remote.
+
+Usage (from the repository root):
+    python tutorials/reference_index.py "/home/jovyan/shared/data/**/gpcp_v02r03_monthly_*.nc" -o gpcp.json
+    python tutorials/reference_index.py "s3://noaa-cdr-sea-surface-temp-optimum-interpolation-pds/data/v2.1/avhrr/2020*/*.nc" -o oisst.parq
+    python tutorials/reference_index.py --manifest "*W1D3*" -o w1d3.json     # files listed in data_manifest.json
+
+and in a notebook:
+    import reference_index
+    ds = reference_index.open_reference('gpcp.json')
+
+Rescanning only processes files that were added or changed since the last scan.
+'''
+import os
+import sys
+import json
+import argparse
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import fsspec
+import xarray as xr
+
+
+def list_files(pattern, storage_options=None):
+    '''
+    Sorted list of the files matching a local or remote (e.g. s3://) glob pattern
+    '''
+    fs, _, paths = fsspec.get_fs_token_paths(pattern, storage_options=storage_options)
+    protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+    if protocol in ('file', 'local'):
+        return sorted(paths)
+    return sorted('%s://%s' % (protocol, path) for path in paths)
+
+
+def manifest_files(pattern):
+    '''
+    Local paths of the entries of data_manifest.json (see pooch_data) whose path matches pattern
+    '''
+    import pooch_data
+
+    root = pooch_data.data_dir()
+    return sorted(os.path.join(root, *entry['path'].split('/')) for entry in pooch_data.load_manifest()['files']
+                  if fnmatch(entry['path'], pattern) and entry['path'].endswith('.nc'))
+
+
+def _file_key(url, storage_options):
+    # identifies a version of a file: size and modification time (or ETag)
+    fs, _, (path,) = fsspec.get_fs_token_paths(url, storage_options=storage_options)
+    info = fs.info(path)
+    return [info.get('size'), str(info.get('mtime') or info.get('LastModified') or info.get('ETag') or '')]
+
+
+def scan_file(url, storage_options=None, inline_threshold=300):
+    '''
+    Kerchunk references of a single netCDF4/HDF5 or netCDF3 file
+    '''
+    with fsspec.open(url, 'rb', **(storage_options or {})) as f:
+        magic = f.read(3)
+        f.seek(0)
+        if magic == b'CDF':
+            from kerchunk.netCDF3 import NetCDF3ToZarr
+            return NetCDF3ToZarr(url, storage_options=storage_options, inline_threshold=inline_threshold).translate()
+        from kerchunk.hdf import SingleHdf5ToZarr
+        return SingleHdf5ToZarr(f, url, inline_threshold=inline_threshold).translate()
+
+
+def _scan(args):
+    url, key, storage_options = args
+    return url, key, scan_file(url, storage_options)
+
+
+def scan_files(urls, storage_options=None, cache_file=None, n_jobs=None):
+    '''
+    References of every file in urls, scanned in parallel
+    With cache_file, the per-file references are kept between runs and only new or changed files are scanned.
+    '''
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+
+    # one metadata request per file (HEAD for remote files), made concurrently and only once per run
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        keys = list(executor.map(lambda url: _file_key(url, storage_options), urls))
+    todo = [(url, key, storage_options) for url, key in zip(urls, keys)
+            if url not in cache or cache[url]['key'] != key]
+    if todo:
+        print('Scanning %i of %i files' % (len(todo), len(urls)))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for url, key, refs in executor.map(_scan, todo, chunksize=max(1, len(todo) // 64)):
+                cache[url] = {'key': key, 'refs': refs}
+
+    if cache_file is not None and todo:
+        cache = {url: cache[url] for url in urls}
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    return [cache[url]['refs'] for url in urls]
+
+
+def combine(refs, concat_dims=('time',), identical_dims=None, storage_options=None):
+    '''
+    Combine single-file references along concat_dims; concatenated coordinates are decoded with their CF units,
+    so files that each count time from their own reference date line up
+    '''
+    from kerchunk.combine import MultiZarrToZarr
+
+    if len(refs) == 1:
+        return refs[0]
+    return MultiZarrToZarr(refs, concat_dims=list(concat_dims), identical_dims=list(identical_dims or []),
+                           coo_map={dim: 'cf:%s' % dim for dim in concat_dims},
+                           remote_protocol=_protocol(refs), remote_options=storage_options).translate()
+
+
+def _protocol(refs):
+    for value in refs[0]['refs'].values():
+        if isinstance(value, list) and value and '://' in value[0]:
+            return value[0].split('://')[0]
+    return None
+
+
+def write_reference(refs, output):
+    '''
+    Write combined references to output: JSON, or parquet (directory) if output ends in .parq / .parquet
+    '''
+    if output.endswith(('.parq', '.parquet')):
+        from kerchunk.df import refs_to_dataframe
+        refs_to_dataframe(refs, output)
+    else:
+        with open(output, 'w') as f:
+            json.dump(refs, f)
+
+
+def build_index(urls, output, concat_dims=('time',), identical_dims=None, storage_options=None, n_jobs=None):
+    '''
+    Scan urls (reusing <output>.files.json from earlier scans) and write the combined reference to output
+    '''
+    refs = scan_files(urls, storage_options, cache_file=output + '.files.json', n_jobs=n_jobs)
+    write_reference(combine(refs, concat_dims, identical_dims, storage_options), output)
+    return output
+
+
+def _reference_protocol(reference):
+    # protocol of the files a reference points to (file if they are local or all chunks are inlined)
+    if reference.endswith(('.parq', '.parquet')):
+        import pandas as pd
+
+        fs, root = fsspec.core.url_to_fs(reference)
+        for part in sorted(fs.find(root)):
+            if part.endswith('.parq'):
+                with fs.open(part) as f:
+                    paths = pd.read_parquet(f, columns=['path'])['path'].dropna()
+                if len(paths):
+                    return paths.iloc[0].split('://')[0] if '://' in paths.iloc[0] else 'file'
+        return 'file'
+    with fsspec.open(reference, 'r') as f:
+        return _protocol([json.load(f)]) or 'file'
+
+
+def open_reference(reference, chunks={}, remote_options=None, remote_protocol=None, **kwargs):
+    '''
+    Open a reference file (JSON or parquet) as one lazy xarray dataset
+    remote_options are passed to the file system of the referenced files, e.g. {'anon': True} for public S3;
+    remote_protocol (e.g. 's3') is read from the reference if not given
+    '''
+    import zarr
+
+    storage_options = {'fo': reference, 'remote_protocol': remote_protocol or _reference_protocol(reference)}
+    if remote_options is not None:
+        storage_options['remote_options'] = dict(remote_options)
+    # zarr 3 reads through async file systems only
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        storage_options['asynchronous'] = True
+        if remote_options is not None:
+            storage_options['remote_options']['asynchronous'] = True
+    return xr.open_dataset('reference://', engine='zarr', chunks=chunks,
+                           backend_kwargs={'consolidated': False, 'storage_options': storage_options}, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a kerchunk reference index over netCDF files')
+    parser.add_argument('patterns', nargs='*', help='glob patterns of local or remote (s3://...) files')
+    parser.add_argument('--manifest', default=None, help='use the data_manifest.json entries whose path matches this pattern')
+    parser.add_argument('-o', '--output', required=True, help='reference file, .json or .parq')
+    parser.add_argument('--concat-dims', default='time', help='comma separated dimensions to concatenate along')
+    parser.add_argument('--identical-dims', default='', help='comma separated coordinates that are the same in every file')
+    parser.add_argument('--anon', action='store_true', help='anonymous access to remote files (public buckets)')
+    parser.add_argument('--jobs', type=int, default=None, help='number of files scanned in parallel')
+    args = parser.parse_args(argv)
+
+    storage_options = {'anon': True} if args.anon else None
+    urls = []
+    for pattern in args.patterns:
+        urls += list_files(pattern, storage_options)
+    if args.manifest is not None:
+        urls += manifest_files(args.manifest)
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        print('No files found')
+        return 1
+
+    build_index(urls, args.output, [d for d in args.concat_dims.split(',') if d],
+                [d for d in args.identical_dims.split(',') if d], storage_options, args.jobs)
+    print('Wrote references to %i files to %s' % (len(urls), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+'''
+Persistent regridding weights and batched regridding of CMIP ensembles
+
+xe.Regridder computes a new weight matrix every time it is created (W2D1 Tutorial 1: "this takes some time to
+calculate a weight matrix"), in every notebook and for every model, although most models of an ensemble share
+a handful of grids. Here the weights are stored on disk (ESMF netCDF format, the one xe.Regridder reads back
+with weights=...) under a key made of the source grid hash, the target grid hash, the method and periodic, so
+they are computed once per unique grid and reused across models, notebooks and sessions.
+
+regrid_ensemble regrids a whole ensemble (dict of datasets or a DataTree): datasets on the same grid are
+regridded together, all their variables, members and experiments stacked into one matrix so every chunk
+costs a single sparse matrix product.
+
+    import regrid_weights
+    ds_target = xr.Dataset({'lat': (['lat'], np.arange(-90, 90, 1.0)), 'lon': (['lon'], np.arange(0, 360, 1.0))})
+    dt_regridded = regrid_weights.regrid_ensemble(dt, ds_target, 'bilinear')
+'''
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+from area_weights import cache_dir
+
+_memory = {}
+
+
+def grid_hash(ds, lat='lat', lon='lon'):
+    '''
+    Hash of the horizontal grid of ds: its cell centers, the cell bounds (lat_b, lon_b) and mask if present
+    '''
+    digest = hashlib.sha1()
+    for name in (lat, lon, lat + '_b', lon + '_b', 'mask'):
+        if name in ds.variables:
+            values = np.ascontiguousarray(ds[name].values)
+            digest.update(name.encode() + str((values.dtype, values.shape)).encode())
+            digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def weights_path(ds_in, ds_out, method='bilinear', periodic=False, **kwargs):
+    '''
+    File of the cached weights from the grid of ds_in to the grid of ds_out; the xe.Regridder options in
+    kwargs (extrap_method, ignore_degenerate, ...) change the weights and are part of the name
+    '''
+    options = ''
+    if kwargs:
+        options = '_' + hashlib.sha1(repr(sorted(kwargs.items())).encode()).hexdigest()[:12]
+    key = '%s_%s_%s%s%s.nc' % (grid_hash(ds_in), grid_hash(ds_out), method, '_peri' if periodic else '', options)
+    return os.path.join(cache_dir(), 'regrid', key)
+
+
+def _horizontal(ds, lat='lat', lon='lon'):
+    # horizontal dims and shape of a grid with 1D (lat, lon) or 2D (y, x) coordinates
+    if ds[lat].ndim == 1:
+        return (ds[lat].dims[0], ds[lon].dims[0]), (ds[lat].size, ds[lon].size)
+    return ds[lat].dims, ds[lat].shape
+
+
+class RegridWeights:
+    '''
+    Sparse (n_out, n_in) regridding matrix between two grids, with the horizontal dims and shapes of both
+    '''
+    def __init__(self, matrix, dims_in, shape_in, dims_out, shape_out, coords_out):
+        self.matrix = matrix
+        self.dims_in, self.shape_in = tuple(dims_in), tuple(shape_in)
+        self.dims_out, self.shape_out = tuple(dims_out), tuple(shape_out)
+        self.coords_out = coords_out
+
+    @classmethod
+    def from_file(cls, fname, ds_in, ds_out):
+        import scipy.sparse
+
+        dims_in, shape_in = _horizontal(ds_in)
+        dims_out, shape_out = _horizontal(ds_out)
+        with xr.open_dataset(fname) as w:
+            # ESMF weight files are 1-based (row: target cell, col: source cell)
+            matrix = scipy.sparse.csr_matrix((w.S.values, (w.row.values - 1, w.col.values - 1)),
+                                             shape=(int(np.prod(shape_out)), int(np.prod(shape_in))))
+        coords_out = {name: ds_out[name] for name in ('lat', 'lon') if name in ds_out.variables}
+        return cls(matrix, dims_in, shape_in, dims_out, shape_out, coords_out)
+
+    def apply(self, block):
+        '''
+        Regrid a numpy array whose last two axes are the source grid
+        '''
+        lead = block.shape[:-2]
+        flat = block.reshape(-1, self.matrix.shape[1])
+        # one sparse x dense product for every leading index (time step, member, variable) at once
+        return np.asarray(self.matrix @ flat.T).T.reshape(lead + self.shape_out)
+
+
+def get_weights(ds_in, ds_out, method='bilinear', periodic=False, **kwargs):
+    '''
+    Regridding weights from the grid of ds_in to the grid of ds_out: from memory, from the weight cache, or
+    computed once with xe.Regridder (extra kwargs are passed to it) and stored in the cache
+    '''
+    fname = weights_path(ds_in, ds_out, method, periodic, **kwargs)
+    if fname in _memory:
+        return _memory[fname]
+    if not os.path.exists(fname):
+        import xesmf as xe
+
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        regridder = xe.Regridder(ds_in, ds_out, method, periodic=periodic, **kwargs)
+        regridder.to_netcdf(fname + '.part')
+        os.replace(fname + '.part', fname)
+    weights = _memory[fname] = RegridWeights.from_file(fname, ds_in, ds_out)
+    return weights
+
+
+def regridder(ds_in, ds_out, method='bilinear', periodic=False, **kwargs):
+    '''
+    xe.Regridder between the grids of ds_in and ds_out built from the cached weights (computed only the first
+    time), a drop-in for xe.Regridder(ds_in, ds_out, method, periodic=periodic)
+    '''
+    import xesmf as xe
+
+    get_weights(ds_in, ds_out, method, periodic, **kwargs)
+    return xe.Regridder(ds_in, ds_out, method, periodic=periodic,
+                        weights=weights_path(ds_in, ds_out, method, periodic, **kwargs), **kwargs)
+
+
+def _regrid_arrays(arrays, weights):
+    # regrid DataArrays on the same grid with one sparse product per chunk: every array is flattened to
+    # (steps, cells_in) and all of them are stacked before the product
+    flats = []
+    for da in arrays:
+        da = da.transpose(..., *weights.dims_in)
+        data = da.data
+        if hasattr(data, 'rechunk'):
+            data = data.rechunk({data.ndim - 2: -1, data.ndim - 1: -1})
+        flats.append(data.reshape((-1,) + weights.shape_in))
+
+    if any(hasattr(flat, 'map_blocks') for flat in flats):
+        import dask.array as dsa
+
+        stacked = dsa.concatenate([dsa.asarray(flat) for flat in flats], axis=0)
+        regridded = stacked.map_blocks(weights.apply, dtype=np.result_type(stacked.dtype, np.float32),
+                                       chunks=(stacked.chunks[0],) + tuple((n,) for n in weights.shape_out))
+    else:
+        regridded = weights.apply(np.concatenate(flats, axis=0))
+
+    out = []
+    start = 0
+    for da in arrays:
+        da = da.transpose(..., *weights.dims_in)
+        lead = da.shape[:-2]
+        n = int(np.prod(lead))
+        # arrays of different dtypes are stacked in the common dtype, give each its own back
+        data = regridded[start:start + n].reshape(lead + weights.shape_out)
+        data = data.astype(np.result_type(da.dtype, np.float32), copy=False)
+        start += n
+        coords = {name: coord for name, coord in da.coords.items() if not set(coord.dims) & set(weights.dims_in)}
+        coords.update(weights.coords_out)
+        out.append(xr.DataArray(data, dims=da.dims[:-2] + weights.dims_out, coords=coords, name=da.name,
+                                attrs=da.attrs))
+    return out
+
+
+def regrid(obj, ds_out, method='bilinear', periodic=False, **kwargs):
+    '''
+    Regrid a Dataset (all variables on the horizontal grid, in one batch) or DataArray to the grid of ds_out
+    '''
+    if isinstance(obj, xr.DataArray):
+        return regrid_ensemble({'': obj.to_dataset(name=obj.name or 'data')}, ds_out, method, periodic,
+                               **kwargs)[''][obj.name or 'data']
+    return regrid_ensemble({'': obj}, ds_out, method, periodic, **kwargs)['']
+
+
+def regrid_ensemble(datasets, ds_out, method='bilinear', periodic=False, **kwargs):
+    '''
+    Regrid every dataset of datasets (dict name -> Dataset, or a DataTree) to the grid of ds_out
+    Weights are computed (or read from the cache) once per unique source grid, and the variables of all
+    datasets on that grid are regridded together. Returns the same structure as datasets.
+    '''
+    tree = None
+    if not isinstance(datasets, dict):
+        tree = datasets
+        datasets = {node.path: node.to_dataset() for node in tree.subtree if node.has_data}
+
+    groups = {}
+    for name, ds in datasets.items():
+        groups.setdefault(grid_hash(ds), []).append(name)
+
+    results = {}
+    for names in groups.values():
+        weights = get_weights(datasets[names[0]], ds_out, method, periodic, **kwargs)
+        arrays = [(name, var) for name in names for var, da in datasets[name].data_vars.items()
+                  if set(weights.dims_in) <= set(da.dims)]
+        regridded = _regrid_arrays([datasets[name][var] for name, var in arrays], weights)
+        for name in names:
+            ds = datasets[name]
+            results[name] = ds.drop_vars([v for v in ds.variables if set(ds[v].dims) & set(weights.dims_in)])
+        for (name, var), da in zip(arrays, regridded):
+            results[name][var] = da
+
+    if tree is not None:
+        return type(tree).from_dict(results)
+    return results